@@ -1,43 +1,198 @@
-from Split_MD import process_markdown
+from Split_MD import stream_markdown, stream_markdown_pages
+from translate_journal import TranslateJournal
+from pdf_convert import save_markdown
+from typing import AsyncIterator, Optional
+import functools
 import pypandoc
+import asyncio
 import os
 import time
 
 
 def Process_MD(
-    md_file: str, translate: callable, thread: int = 10, output_path: str = "./Output"
-):
+    md_file: str,
+    translate: callable,
+    thread: int = 10,
+    output_path: str = "./Output",
+    cache=None,
+    resume: bool = False,
+    memory=None,
+) -> dict:
+    """Translate a markdown file to markdown and, if pandoc works, docx
+
+    Returns:
+        dict: Paths of the ``markdown`` and ``docx`` outputs, ``docx`` is None
+              if the conversion failed
+    """
+    output_md_path = translate_markdown_file(
+        md_file, translate, thread, output_path, cache, resume, memory
+    )
+    return {
+        "markdown": output_md_path,
+        "docx": render_docx(output_md_path, output_path),
+    }
+
+
+def translate_markdown_file(
+    md_file: str,
+    translate: callable,
+    thread: int = 10,
+    output_path: str = "./Output",
+    cache=None,
+    resume: bool = False,
+    memory=None,
+) -> str:
+    """Translate a markdown file and return the path of the translated markdown"""
     print(f"Processing markdown file: {md_file}")
-    with open(md_file, "r", encoding="utf-8") as f:
-        input_md = f.read()
-    output_md = process_markdown(
-        input_markdown=input_md, translate=translate, thread=thread
+    journal = open_journal(md_file, output_path, resume)
+    output_md_path = translated_md_path(md_file, output_path)
+    # Translated blocks are appended to the output as they complete
+    try:
+        with open(md_file, "r", encoding="utf-8") as f_in, open(
+            output_md_path, "w", encoding="utf-8"
+        ) as f_out:
+            stream_markdown(
+                input_markdown=f_in.read(),
+                output_file=f_out,
+                translate=translate,
+                thread=thread,
+                cache=cache,
+                journal=journal,
+                memory=memory,
+            )
+    finally:
+        journal.close()
+        if cache is not None:
+            cache.flush()
+    print_summaries(translate, cache, memory)
+    journal.remove()
+
+    print(f"Translated markdown saved to {output_path}")
+    return output_md_path
+
+
+def translate_pdf_pages(
+    pdf_file: str,
+    pages: AsyncIterator[str],
+    translate: callable,
+    thread: int = 10,
+    output_path: str = "./Output",
+    cache=None,
+    resume: bool = False,
+    memory=None,
+) -> str:
+    """Translate the pages of a PDF as its conversion makes them available
+
+    The converted markdown is saved next to the translation once every page
+    has arrived, as if the PDF had been converted first. If the pages end with
+    an error, e.g. ConversionStopped, it propagates: neither the converted
+    markdown nor the removal of the journal happen, so the run can be resumed.
+
+    Args:
+        pdf_file: The PDF being converted
+        pages: Async iterator of the markdown of each page, in page order
+
+    Returns:
+        str: The path of the translated markdown
+    """
+    print(f"Translating the pages of {pdf_file} as they are converted")
+    journal = open_journal(pdf_file, output_path, resume)
+    output_md_path = translated_md_path(pdf_file, output_path)
+    try:
+        with open(output_md_path, "w", encoding="utf-8") as f_out:
+            texts = asyncio.run(
+                stream_markdown_pages(
+                    pages,
+                    output_file=f_out,
+                    translate=translate,
+                    thread=thread,
+                    cache=cache,
+                    journal=journal,
+                    memory=memory,
+                )
+            )
+    finally:
+        journal.close()
+        if cache is not None:
+            cache.flush()
+    # Only reached once every page was received and translated
+    save_markdown(texts, pdf_file, output_path)
+    print_summaries(translate, cache, memory)
+    journal.remove()
+
+    print(f"Translated markdown saved to {output_path}")
+    return output_md_path
+
+
+def open_journal(source_file: str, output_path: str, resume: bool) -> TranslateJournal:
+    # Finished blocks are journaled so an interrupted run can be resumed
+    journal_path = os.path.join(
+        output_path,
+        ".".join(os.path.basename(source_file).split(".")[:-1]) + ".journal.jsonl",
     )
-    output_md_path = os.path.join(
+    journal = TranslateJournal(journal_path, resume=resume)
+    if journal.done:
+        print(f"Resuming from {journal_path}: {len(journal.done)} blocks done")
+    return journal
+
+
+def translated_md_path(source_file: str, output_path: str) -> str:
+    os.makedirs(output_path, exist_ok=True)
+    return os.path.join(
         output_path,
-        ".".join(os.path.basename(md_file).split(".")[:-1])
+        ".".join(os.path.basename(source_file).split(".")[:-1])
         + "_translated_"
         + time.strftime("%Y%m%d_%H%M%S")
         + ".md",
     )
-    os.makedirs(output_path, exist_ok=True)
-    with open(output_md_path, "w", encoding="utf-8") as f:
-        f.write(output_md)
 
-    print(f"Translated markdown saved to {output_path}")
+
+def print_summaries(translate: callable, cache=None, memory=None) -> None:
+    if cache is not None:
+        print(cache.summary())
+    if memory is not None:
+        print(memory.summary())
+    limiter = getattr(translate, "limiter", None)
+    if limiter is not None:
+        print(limiter.summary())
+    usage = getattr(translate, "usage", None)
+    if usage is not None:
+        print(usage.summary())
+
+
+@functools.lru_cache(maxsize=None)
+def reference_docx() -> Optional[str]:
+    """Absolute path of reference.docx, looked up once per process"""
+    path = os.path.abspath("reference.docx")
+    return path if os.path.exists(path) else None
+
+
+def render_docx(output_md_path: str, output_path: str = "./Output"):
+    """Convert a translated markdown file to docx with pandoc
+
+    Each call runs a single pandoc process, so several documents can be
+    rendered at the same time from different threads.
+
+    Returns:
+        The path of the docx file, or None if the conversion failed
+    """
     print("Trying ranslating markdown to docx...")
+    output_docx_path = output_md_path.replace(".md", ".docx")
     try:
-        output_docx_path = output_md_path.replace(".md", ".docx")
-        reference_docx = os.path.abspath("reference.docx")
         extra_args = [f"--resource-path={output_path}"]
-        if os.path.exists(reference_docx):
-            extra_args.append(f"--reference-doc={reference_docx}")
+        if reference_docx() is not None:
+            extra_args.append(f"--reference-doc={reference_docx()}")
         pypandoc.convert_file(
             output_md_path,
             "docx",
             outputfile=output_docx_path,
             extra_args=extra_args,
+            # The formats are known to be valid, checking them would run
+            # pandoc twice more to list the formats it supports
+            verify_format=False,
         )
         print(f"Translated docx saved to {output_docx_path}")
     except Exception as e:
         print(f"Error converting markdown to docx: {e}")
+        return None
+    return output_docx_path
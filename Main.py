@@ -1,13 +1,33 @@
 from dotenv import load_dotenv
+from typing import List
+import argparse
+import asyncio
 import os
-from pdfdeal.file_tools import md_replace_imgs
 from Translates.OpenAI import openai_translate
 from Translates.Ollama import ollama_translate
 from Translates.DeepSeek import deepseek_translate
 from Translates.DeepLX import deeplx_translate
 from Translates.DeepL import deepl_translate
-from MD_Translate import Process_MD
-from pdfdeal import Doc2X
+from Translates.RateLimit import RateLimiter
+from MD_Translate import (
+    render_docx,
+    translate_markdown_file,
+    translate_pdf_pages,
+)
+from Split_MD import run_translate
+from translate_cache import TranslateCache
+from translation_memory import TranslationMemory
+from batch_translate import (
+    Document,
+    Manifest,
+    Stage,
+    find_documents,
+    output_dirs,
+    run_pipeline,
+)
+from pdf_convert import Doc2XJobManager, save_markdown
+from doc2x_cache import ConversionCache
+from image_fetch import ImageFetcher, image_folder
 
 ENV_PATH = ".env" if os.path.exists(".env") else "example.env"
 load_dotenv(ENV_PATH)
@@ -48,9 +68,9 @@ input_prompt = None if input_prompt == "" else input_prompt
 def get_translator(choice=None):
     """Get translator based on environment variable or user selection"""
     if choice:
-        return create_translator(choice)
+        return apply_chunk_tokens(create_translator(choice))
     if translate_use:
-        return create_translator(translate_use)
+        return apply_chunk_tokens(create_translator(translate_use))
 
     print("Please select a translator:")
     print("1. OpenAI")
@@ -73,9 +93,17 @@ def get_translator(choice=None):
 
     if choice not in translators:
         print("Invalid choice, using deepseek as default")
-        return create_translator("deepseek")
+        return apply_chunk_tokens(create_translator("deepseek"))
 
-    return create_translator(translators[choice])
+    return apply_chunk_tokens(create_translator(translators[choice]))
+
+
+def apply_chunk_tokens(translator):
+    """Override the translator's token budget per chunk with CHUNK_TOKENS, if set"""
+    chunk_tokens = int(os.getenv("CHUNK_TOKENS", 0) or 0)
+    if chunk_tokens > 0:
+        translator.chunk_tokens = chunk_tokens
+    return translator
 
 
 def create_translator(name):
@@ -104,10 +132,24 @@ def create_translator(name):
     extra_type = os.getenv("extra_type", "markdown")
     llm_src = os.getenv("llm_src", "English")
     llm_dest = os.getenv("llm_dest", "中文")
+    llm_batch_size = int(os.getenv("llm_batch_size", 1))
+    llm_batch_chars = int(os.getenv("llm_batch_chars", 4000))
+    prompt_profile = os.getenv("prompt_profile", "quality")
+    llm_stream = os.getenv("llm_stream", "false").lower() == "true"
 
     system_prompt = None if system_prompt == "" else system_prompt
     input_prompt = None if input_prompt == "" else input_prompt
 
+    # One pooled connection per concurrent request
+    pool_size = int(os.getenv("THREADS", 10))
+    # THREADS is the ceiling, the limiter adapts the actual concurrency
+    limiter = RateLimiter(
+        max_concurrency=pool_size,
+        requests_per_minute=int(os.getenv("REQUESTS_PER_MINUTE", 0) or 0),
+        tokens_per_minute=int(os.getenv("TOKENS_PER_MINUTE", 0) or 0),
+        max_retries=int(os.getenv("MAX_RETRIES", 5)),
+    )
+
     if name == "openai":
         if not openai_apikey or openai_apikey == "sk-1234567":
             print("Error: OpenAI API key not set")
@@ -122,6 +164,12 @@ def create_translator(name):
             system_prompt=system_prompt if system_prompt else None,
             input_prompt=input_prompt if input_prompt else None,
             extra_type=extra_type,
+            prompt_profile=prompt_profile,
+            stream=llm_stream,
+            pool_size=pool_size,
+            limiter=limiter,
+            batch_size=llm_batch_size,
+            batch_chars=llm_batch_chars,
         )
     elif name == "ollama":
         return ollama_translate(
@@ -133,6 +181,12 @@ def create_translator(name):
             system_prompt=system_prompt if system_prompt else None,
             input_prompt=input_prompt if input_prompt else None,
             extra_type=extra_type,
+            prompt_profile=prompt_profile,
+            stream=llm_stream,
+            pool_size=pool_size,
+            limiter=limiter,
+            batch_size=llm_batch_size,
+            batch_chars=llm_batch_chars,
         )
     elif name == "deepseek":
         if not deepseek_api or deepseek_api == "sk-1234567":
@@ -146,75 +200,411 @@ def create_translator(name):
             system_prompt=system_prompt if system_prompt else None,
             input_prompt=input_prompt if input_prompt else None,
             extra_type=extra_type,
+            prompt_profile=prompt_profile,
+            stream=llm_stream,
+            pool_size=pool_size,
+            limiter=limiter,
+            batch_size=llm_batch_size,
+            batch_chars=llm_batch_chars,
         )
     elif name == "deeplx":
-        return deeplx_translate(base_url=deeplx_url, src=deeplx_src, dest=deeplx_dest)
+        return deeplx_translate(
+            base_url=deeplx_url,
+            src=deeplx_src,
+            dest=deeplx_dest,
+            pool_size=pool_size,
+            limiter=limiter,
+        )
     elif name == "deepl":
         if not deepl_apikey or deepl_apikey == "":
             print("Error: DeepL API key not set")
             raise Exception("DeepL API key not set")
-        return deepl_translate(api_key=deepl_apikey, dest=deepl_dest)
+        return deepl_translate(
+            api_key=deepl_apikey, dest=deepl_dest, pool_size=pool_size, limiter=limiter
+        )
     elif name == "google":
         from Translates.Google import google_translate
 
         return google_translate(
-            src=os.getenv("google_src", "en"), dest=os.getenv("google_dest", "zh-cn")
+            src=os.getenv("google_src", "en"),
+            dest=os.getenv("google_dest", "zh-cn"),
+            limiter=limiter,
         )
     else:
         print(f"Unknown translator: {name}")
         raise Exception(f"Unknown translator: {name}")
 
 
+def create_cache(enabled: bool = None):
+    """Create the translation cache based on environment variables
+
+    Returns None when the cache is disabled.
+    """
+    if enabled is None:
+        enabled = os.getenv("TRANSLATE_CACHE", "true").lower() == "true"
+    if not enabled:
+        return None
+    return TranslateCache(
+        path=os.getenv("CACHE_PATH", "./Output/translate_cache.sqlite3"),
+        max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 100000)),
+    )
+
+
+def create_memory(enabled: bool = None):
+    """Create the translation memory based on environment variables
+
+    Returns None when the translation memory is disabled.
+    """
+    if enabled is None:
+        enabled = os.getenv("TRANSLATION_MEMORY", "true").lower() == "true"
+    if not enabled:
+        return None
+    return TranslationMemory(
+        path=os.getenv("MEMORY_PATH", "./Output/translation_memory.sqlite3"),
+        similarity=float(os.getenv("MEMORY_SIMILARITY", 0.7)),
+        max_entries=int(os.getenv("MEMORY_MAX_ENTRIES", 100000)),
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Translate markdown or PDF files while keeping formulas/tables/images"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the translation cache and memory for this run",
+    )
+    parser.add_argument(
+        "--purge-cache",
+        action="store_true",
+        help="Remove all cached translations and the translation memory before running",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Neither use nor update the translation memory for this run",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted job, only translating the blocks not yet done "
+        "(and in batch mode, only the documents not yet done)",
+    )
+    parser.add_argument(
+        "--input",
+        help="Translate every markdown/PDF file of a directory (recursively) or "
+        "glob pattern, or a single file, without prompting",
+    )
+    parser.add_argument(
+        "--translator",
+        choices=["openai", "ollama", "deepseek", "deeplx", "deepl", "google"],
+        help="Translator to use, overrides TRANSLATE_USE and skips the prompt",
+    )
+    parser.add_argument(
+        "--output",
+        default="Output",
+        help="Folder of the outputs, batch mode mirrors the input folders below it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("DOCUMENT_WORKERS", 4)),
+        help="Number of documents translated at the same time in batch mode",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Path of the batch manifest, defaults to manifest.json in the output folder",
+    )
+    return parser.parse_args()
+
+
+def convert_pdf(file_path: str, output_path: str = "Output", fetcher=None) -> str:
+    """Convert a PDF to markdown with Doc2X and return the path of the markdown file"""
+    print("Converting PDF to markdown using Doc2X...")
+    jobs = create_job_manager(fetcher=fetcher)
+    texts = asyncio.run(jobs.wait(jobs.upload(file_path)))
+    if jobs.cache is not None:
+        print(jobs.cache.summary())
+    if not texts:
+        print("Error: PDF to markdown conversion failed")
+        raise Exception("PDF to markdown conversion failed")
+    return save_markdown(texts, file_path, output_path)
+
+
+def process_document(
+    file_path: str,
+    translator: callable,
+    output_path: str = "Output",
+    cache=None,
+    memory=None,
+    resume: bool = False,
+    fetcher=None,
+) -> dict:
+    """Convert (if a PDF), translate and fetch the images of one document
+
+    Images are downloaded in the background while the document is translated.
+    With PAGE_STREAMING, the pages of a PDF are translated as soon as Doc2X
+    has converted them.
+
+    Returns:
+        dict: Paths of the outputs, as returned by Process_MD
+    """
+    if fetcher is None:
+        fetcher = create_image_fetcher()
+    if (
+        file_path.endswith(".pdf")
+        and os.getenv("PAGE_STREAMING", "true").lower() == "true"
+    ):
+        jobs = create_job_manager(fetcher=fetcher)
+        print("Uploading PDF to Doc2X...")
+        job = jobs.upload(file_path)
+        output_md_path = translate_pdf_pages(
+            file_path,
+            fetcher.prefetch_pages(jobs.pages(job)),
+            translator,
+            thread=threads,
+            output_path=output_path,
+            cache=cache,
+            resume=resume,
+            memory=memory,
+        )
+        print("Waiting for images(If have)...")
+        fetcher.replace_images(output_md_path)
+        print(fetcher.summary())
+        if jobs.cache is not None:
+            print(jobs.cache.summary())
+        return {
+            "markdown": output_md_path,
+            "docx": render_docx(output_md_path, output_path),
+        }
+    if file_path.endswith(".pdf"):
+        file_path = convert_pdf(file_path, output_path, fetcher)
+    with open(file_path, "r", encoding="utf-8") as f:
+        fetcher.prefetch(f.read())
+    output_md_path = translate_markdown_file(
+        file_path,
+        translator,
+        thread=threads,
+        output_path=output_path,
+        cache=cache,
+        resume=resume,
+        memory=memory,
+    )
+    print("Waiting for images(If have)...")
+    fetcher.replace_images(file_path)
+    fetcher.replace_images(output_md_path, folder=image_folder(file_path))
+    print(fetcher.summary())
+    return {
+        "markdown": output_md_path,
+        "docx": render_docx(output_md_path, output_path),
+    }
+
+
+def create_image_fetcher():
+    """Create the image fetcher based on environment variables"""
+    return ImageFetcher(
+        path=os.getenv("IMAGE_CACHE_PATH", "./Output/image_cache"),
+        threads=int(os.getenv("IMAGE_THREADS", 10)),
+        revalidate=os.getenv("IMAGE_REVALIDATE", "true").lower() == "true",
+    )
+
+
+def create_conversion_cache(enabled: bool = None, fetcher=None):
+    """Create the Doc2X conversion cache based on environment variables
+
+    Returns None when the conversion cache is disabled.
+    """
+    if enabled is None:
+        enabled = os.getenv("DOC2X_CACHE", "true").lower() == "true"
+    if not enabled:
+        return None
+    return ConversionCache(
+        path=os.getenv("DOC2X_CACHE_PATH", "./Output/doc2x_cache"),
+        fetcher=fetcher if fetcher is not None else create_image_fetcher(),
+    )
+
+
+def create_job_manager(apikey: str = None, on_progress: callable = None, fetcher=None):
+    """Create the Doc2X job manager based on environment variables"""
+    return Doc2XJobManager(
+        apikey=apikey if apikey is not None else os.getenv("DOC2X_APIKEY"),
+        max_uploads=int(os.getenv("DOC2X_UPLOADS", 4)),
+        min_interval=float(os.getenv("DOC2X_MIN_POLL", 1)),
+        max_interval=float(os.getenv("DOC2X_MAX_POLL", 15)),
+        on_progress=on_progress,
+        cache=create_conversion_cache(fetcher=fetcher),
+    )
+
+
+def pipeline_stages(
+    translator: callable,
+    cache=None,
+    memory=None,
+    resume: bool = False,
+    workers: int = 4,
+    on_progress: callable = None,
+    fetcher=None,
+    jobs=None,
+) -> List[Stage]:
+    """Stages of batch mode: upload, convert, translate, image fetch and docx
+
+    Images start downloading once a document is converted and are only
+    waited for after its translation. on_progress is called with the
+    Doc2XJob of a PDF whenever its conversion progresses, unless the
+    Doc2XJobManager ``jobs`` is given.
+    """
+    if fetcher is None:
+        fetcher = create_image_fetcher()
+    if jobs is None:
+        jobs = create_job_manager(on_progress=on_progress, fetcher=fetcher)
+
+    def upload_stage(document: Document) -> None:
+        if document.source.endswith(".pdf"):
+            print(f"Uploading {document.source} to Doc2X...")
+            document.job = jobs.upload(document.source)
+
+    def convert_stage(document: Document) -> None:
+        if document.job is None:
+            document.markdown = document.source
+        else:
+            texts = asyncio.run(jobs.wait(document.job))
+            if not texts:
+                raise Exception("PDF to markdown conversion failed")
+            document.markdown = save_markdown(
+                texts, document.source, document.output_path
+            )
+        with open(document.markdown, "r", encoding="utf-8") as f:
+            fetcher.prefetch(f.read())
+
+    def images_stage(document: Document) -> None:
+        fetcher.replace_images(document.markdown)
+        fetcher.replace_images(
+            document.outputs["markdown"], folder=image_folder(document.markdown)
+        )
+
+    def translate_stage(document: Document) -> None:
+        document.outputs["markdown"] = translate_markdown_file(
+            document.markdown,
+            translator,
+            thread=threads,
+            output_path=document.output_path,
+            cache=cache,
+            resume=resume,
+            memory=memory,
+        )
+
+    def docx_stage(document: Document) -> None:
+        document.outputs["docx"] = render_docx(
+            document.outputs["markdown"], document.output_path
+        )
+
+    return [
+        Stage("uploading", upload_stage, workers=jobs.max_uploads),
+        Stage("converting", convert_stage, workers=int(os.getenv("DOC2X_WORKERS", 4))),
+        Stage("translating", translate_stage, workers=workers),
+        Stage("fetching images", images_stage, workers=2),
+        Stage("rendering", docx_stage, workers=int(os.getenv("DOCX_WORKERS", 2))),
+    ]
+
+
 def main():
+    args = parse_args()
+    cache = None if args.no_cache else create_cache()
+    if args.purge_cache:
+        purge_target = cache if cache is not None else create_cache(enabled=True)
+        purge_target.purge()
+        print(f"Translation cache purged: {purge_target.path}")
+    # The memory would serve the translations the cache flags discard
+    memory = None if args.no_memory or args.no_cache else create_memory()
+    if args.purge_cache:
+        purge_target = memory if memory is not None else create_memory(enabled=True)
+        purge_target.purge()
+        print(f"Translation memory purged: {purge_target.path}")
+
     # Get translator
-    translator = get_translator()
+    if args.input is not None and not (args.translator or translate_use):
+        # Batch mode runs unattended, it must not wait for a choice
+        print("Error: Batch mode needs a translator, set TRANSLATE_USE or --translator")
+        raise ValueError(
+            "Batch mode needs a translator, set TRANSLATE_USE or --translator"
+        )
+    translator = get_translator(args.translator)
     if os.getenv("SKIP_TEST", "false").lower() != "true":
         print("Testing translator...")
-        test = translator("Hello, how are you?", "", "")
+        test = run_translate(translator, "Hello, how are you?")
         if test == "Hello, how are you?":
             print("Translator test failed, please check your settings")
             raise Exception("Translator test failed")
         print(f"Translator test successful: {test}")
 
-    # Get file path from user
-    file_path = input("Please enter the path to your markdown or PDF file: ")
-
-    if not os.path.exists(file_path):
-        print(f"Error: File {file_path} does not exist")
-        raise FileNotFoundError(f"File {file_path} does not exist")
-
-    if not file_path.endswith(".md") and not file_path.endswith(".pdf"):
-        print("Error: File must be a markdown file (.md) or a PDF file (.pdf)")
-        raise ValueError("File must be a markdown file (.md) or a PDF file (.pdf)")
-
-    if file_path.endswith(".pdf"):
-        print("Converting PDF to markdown using Doc2X...")
-        if (
-            os.getenv("DOC2X_APIKEY") == "sk-1234567"
-            or os.getenv("DOC2X_APIKEY") == ""
-            or os.getenv("DOC2X_APIKEY") is None
-        ):
-            print("Error: Please set your DOC2X_APIKEY")
-            raise Exception("Please set your DOC2X_APIKEY")
-        client = Doc2X(debug=True)
-        md_text, _, flag = client.pdf2file(
-            pdf_file=file_path,
-            output_format="text",
-        )
-        if flag:
-            print("Error: PDF to markdown conversion failed")
-            raise Exception("PDF to markdown conversion failed")
-        output_md_path = os.path.join(
-            "Output", ".".join(os.path.basename(file_path).split(".")[:-1]) + ".md"
+    fetcher = create_image_fetcher()
+    try:
+        if args.input is not None:
+            # Batch mode: every matching document, without any prompt
+            documents = find_documents(args.input, exclude=args.output)
+            if not documents:
+                print(f"Error: No markdown or PDF file found for {args.input}")
+                raise FileNotFoundError(
+                    f"No markdown or PDF file found for {args.input}"
+                )
+            print(f"Translating {len(documents)} documents")
+            folders = output_dirs(documents, args.output)
+            manifest = Manifest(
+                args.manifest or os.path.join(args.output, "manifest.json")
+            )
+            jobs = create_job_manager(
+                # Conversion progress of every PDF, as reported by Doc2X
+                on_progress=lambda job: manifest.update(
+                    job.pdf_file, doc2x_status=job.status, doc2x_progress=job.progress
+                ),
+                fetcher=fetcher,
+            )
+            run_pipeline(
+                [
+                    Document(source=document, output_path=folders[document])
+                    for document in documents
+                ],
+                pipeline_stages(
+                    translator,
+                    cache,
+                    memory,
+                    args.resume,
+                    args.workers,
+                    fetcher=fetcher,
+                    jobs=jobs,
+                ),
+                manifest,
+                queue_size=int(os.getenv("PIPELINE_QUEUE_SIZE", 2)),
+                skip_done=args.resume,
+            )
+            print(fetcher.summary())
+            if jobs.cache is not None:
+                print(jobs.cache.summary())
+            return
+
+        # Get file path from user
+        file_path = input("Please enter the path to your markdown or PDF file: ")
+
+        if not os.path.exists(file_path):
+            print(f"Error: File {file_path} does not exist")
+            raise FileNotFoundError(f"File {file_path} does not exist")
+
+        if not file_path.endswith(".md") and not file_path.endswith(".pdf"):
+            print("Error: File must be a markdown file (.md) or a PDF file (.pdf)")
+            raise ValueError("File must be a markdown file (.md) or a PDF file (.pdf)")
+
+        process_document(
+            file_path,
+            translator,
+            output_path=args.output,
+            cache=cache,
+            memory=memory,
+            resume=args.resume,
+            fetcher=fetcher,
         )
-        os.makedirs("Output", exist_ok=True)
-        with open(output_md_path, "w") as f:
-            f.write(md_text[0])
-        file_path = output_md_path
-    print("Starting to download images(If have)...")
-    md_replace_imgs(mdfile=file_path, replace="local", threads=10)
-    # Process the file
-    Process_MD(md_file=file_path, translate=translator, thread=threads)
+    finally:
+        fetcher.close()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
 import re
 from dataclasses import dataclass
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
+import asyncio
+import collections
 import concurrent.futures
+import functools
+import inspect
 from tqdm import tqdm
 
 
@@ -13,57 +17,80 @@ class Block:
     content: str = ""
 
 
+# Markdown normalisations applied before splitting. Each rewrite only runs when
+# its trigger appears in the document, and literal rewrites use str.replace.
+ADJUSTBOX_PATTERN = re.compile(
+    r"\\begin{center}\s*\\adjustbox{max width=\\textwidth}{\s*(.*?)\s*\\end{tabular}\s*}\s*\\end{center}",
+    re.DOTALL,
+)
+TAG_PATTERN = re.compile(r"\\tag\{(.*?)\}")
+COMMENT_PATTERN = re.compile(r"<!-- (?:Media|Footnote) -->\n?")
+MATH_DELIMITERS = [
+    # Replace \( \) with $ and \[ \] with $$ for math expressions
+    ("\\(", "$"),
+    ("\\)", "$"),
+    ("\\[", "$$"),
+    ("\\]", "$$"),
+    # Replace $$$$ with $$\n$$ for better readability
+    ("$$$$", "$$\n$$"),
+]
+
+# Block types found by split_markdown, keyed by the name of their pattern group
+BLOCK_TYPES = {
+    "title": "title",
+    "table": "table",
+    "block_formula": "block_formula",
+    "img": "image",
+    "link_img": "link_image",
+    "link": "link",
+}
+BLOCK_PATTERN = re.compile(
+    # Every block starts with one of these characters, skip other positions quickly
+    r"(?=[#<$!\[])(?:"
+    r"(?P<title>^#{1,6} .+?$)|"
+    r"(?P<table><table[\s\S]*?<\/table>)|"
+    r"(?P<block_formula>\$\$[\s\S]+?\$\$)|"
+    r'(?P<img><img src="[^"]+"\/?>)|'
+    r"(?P<link_img>!\[.*?\]\([^\)]+\))|"
+    r"(?P<link>\[[^\]]+\]\([^\)]+\)))",
+    re.MULTILINE,
+)
+
+
+def preprocess_markdown(content: str) -> str:
+    """Normalise Doc2X markdown: unwrap adjustbox tables, rewrite \\tag, drop
+    media/footnote comments and use $ delimiters for all math"""
+    if "\\adjustbox{" in content:
+        content = ADJUSTBOX_PATTERN.sub(
+            r"\\begin{center}\n\1\n\\end{tabular}\n\\end{center}", content
+        )
+    if "\\tag{" in content:
+        content = TAG_PATTERN.sub(r"\\qquad \\text{(\1)}", content)
+    # Remove media and footnote comments
+    if "<!-- " in content:
+        content = COMMENT_PATTERN.sub("", content)
+    for old, new in MATH_DELIMITERS:
+        if old in content:
+            content = content.replace(old, new)
+    return content
+
+
 def split_markdown(content: str) -> List[Block]:
     A = []
-    pattern = re.compile(
-        r"(?P<title>^#{1,6} .+?$)|"
-        r"(?P<table><table[\s\S]*?<\/table>)|"
-        r"(?P<block_formula>\$\$[\s\S]+?\$\$)|"
-        r'(?P<img><img src="[^"]+"\/?>)|'
-        r"(?P<link_img>!\[.*?\]\([^\)]+\))|"
-        r"(?P<link>\[[^\]]+\]\([^\)]+\))",
-        re.MULTILINE,
-    )
-
     pos = 0
-    for match in pattern.finditer(content):
+    for match in BLOCK_PATTERN.finditer(content):
         start, end = match.span()
         if start > pos:
             text = content[pos:start].strip()
             if text:
                 A.append(Block(position=len(A) + 1, type="text", content=text))
-        if match.group("title"):
-            A.append(
-                Block(position=len(A) + 1, type="title", content=match.group("title"))
-            )
-        elif match.group("table"):
-            A.append(
-                Block(position=len(A) + 1, type="table", content=match.group("table"))
-            )
-        elif match.group("block_formula"):
-            A.append(
-                Block(
-                    position=len(A) + 1,
-                    type="block_formula",
-                    content=match.group("block_formula"),
-                )
-            )
-        elif match.group("img"):
-            A.append(
-                Block(position=len(A) + 1, type="image", content=match.group("img"))
-            )
-        elif match.group("link_img"):
-            A.append(
-                Block(
-                    position=len(A) + 1,
-                    type="link_image",
-                    content=match.group("link_img"),
-                )
-            )
-        elif match.group("link"):
-            A.append(
-                Block(position=len(A) + 1, type="link", content=match.group("link"))
+        A.append(
+            Block(
+                position=len(A) + 1,
+                type=BLOCK_TYPES[match.lastgroup],
+                content=match.group(),
             )
+        )
         pos = end
     if pos < len(content):
         text = content[pos:].strip()
@@ -72,175 +99,876 @@ def split_markdown(content: str) -> List[Block]:
     return A
 
 
-def split_text_blocks(A: List[Block]) -> List[Block]:
-    end_punctuations = re.compile(r"[。？！.!?;；]")
+# Default token budget per text chunk for translators without a chunk_tokens attribute
+DEFAULT_CHUNK_TOKENS = 256
+
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+PARAGRAPH_PATTERN = re.compile(r".+?(?:\n\s*\n|$)", re.DOTALL)
+SENTENCE_END_PATTERN = re.compile(r"(?<=[。？！；])|(?<=[.!?;])(?=\s)")
+
+_tokenizer = None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text
+
+    Uses tiktoken when it is installed, otherwise estimates one token per CJK
+    character and one token per four other characters.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            import tiktoken
+
+            _tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tokenizer = False
+    if _tokenizer:
+        return len(_tokenizer.encode(text, disallowed_special=()))
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """Split a text into chunks of at most max_tokens tokens
+
+    Chunks are cut at paragraph boundaries when possible, then at sentence
+    boundaries, and only a single sentence longer than the budget is cut
+    in the middle.
+    """
+    units = []
+    for paragraph in PARAGRAPH_PATTERN.findall(text):
+        tokens = count_tokens(paragraph)
+        if tokens <= max_tokens:
+            units.append((paragraph, tokens))
+            continue
+        for sentence in SENTENCE_END_PATTERN.split(paragraph):
+            tokens = count_tokens(sentence)
+            if tokens <= max_tokens:
+                units.append((sentence, tokens))
+                continue
+            step = max(1, len(sentence) * max_tokens // tokens)
+            start = 0
+            while start < len(sentence):
+                end = min(start + step, len(sentence))
+                if end < len(sentence):
+                    # Prefer cutting after a space over cutting a word in half
+                    space = sentence.rfind(" ", start, end)
+                    if space > start:
+                        end = space + 1
+                piece = sentence[start:end]
+                units.append((piece, count_tokens(piece)))
+                start = end
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for unit, tokens in units:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("".join(current))
+            current = []
+            current_tokens = 0
+        current.append(unit)
+        current_tokens += tokens
+    if current:
+        chunks.append("".join(current))
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def split_text_blocks(
+    A: List[Block], max_tokens: int = DEFAULT_CHUNK_TOKENS
+) -> List[Block]:
+    """Split text blocks into chunks that fit the translator's token budget
+
+    Args:
+        A: Blocks as returned by split_markdown
+        max_tokens: Token budget of a single chunk
+
+    Returns:
+        List[Block]: The blocks, with long text blocks split into several
+    """
     new_blocks = []
     for block in A:
         if block.type == "text":
-            text = block.content
-            start = 0
-            while start < len(text):
-                end = start + 512
-                if end >= len(text):
-                    end = len(text)
-                else:
-                    match = end_punctuations.search(text, end)
-                    if match:
-                        end = match.end()
-                    else:
-                        end = min(start + 1024, len(text))
-                segment = text[start:end].strip()
-                if segment:
-                    new_blocks.append(
-                        Block(
-                            position=block.position,
-                            sub_position=len(new_blocks) + 1,
-                            type="text",
-                            content=segment,
-                        )
+            for segment in chunk_text(block.content, max_tokens):
+                new_blocks.append(
+                    Block(
+                        position=block.position,
+                        sub_position=len(new_blocks) + 1,
+                        type="text",
+                        content=segment,
                     )
-                start = end
+                )
         else:
             new_blocks.append(block)
     return new_blocks
 
 
-def replace_inline_formula(
-    text: str, placeholder_counter: int, placeholders: dict
-) -> str:
-    inline_formula_pattern = re.compile(r"\$[^$]+\$")
+def build_context_index(A: List[Block]) -> List[Tuple[str, str]]:
+    """Precompute the previous/next context of every block in a single pass
 
-    def replacer(match):
-        nonlocal placeholder_counter
-        placeholder = f"⚛️{placeholder_counter}⚛️"
-        placeholders[placeholder] = match.group()
-        placeholder_counter += 1
-        return placeholder
+    A text block's previous context is the nearest earlier block with the same
+    position and the preceding sub_position (or, for sub_position 1, the
+    previous position); its next context is the nearest later block with the
+    following sub_position or the next position. Contents are snapshotted
+    before translation starts, so the context is always the source text.
 
-    return inline_formula_pattern.sub(replacer, text)
+    Args:
+        A: Blocks as returned by split_text_blocks
 
+    Returns:
+        List[Tuple[str, str]]: (prev_text, next_text) for each block, by index
+    """
+    prev_texts = [""] * len(A)
+    next_texts = [""] * len(A)
 
-def concurrent_translate(
-    A: List[Block], translate: callable, thread: int
-) -> List[Block]:
-    placeholders = {}
-    placeholder_counter = 1
-
-    def process_block(block: Block):
-        nonlocal placeholder_counter
-        if block.type in ["table", "block_formula", "image", "link_image", "link"]:
-            return block
-        elif block.type == "title":
-            content = block.content.lstrip("#").strip()
-            translated = translate(content, "", "")
-            block.content = translated
-            return block
-        elif block.type == "text":
-            prev_block = None
-            next_block = None
+    # Forward pass: nearest earlier block by (position, sub_position) or position
+    seen_segment = {}
+    seen_position = {}
+    for i, block in enumerate(A):
+        if block.type == "text":
             if block.sub_position > 1:
-                for b in reversed(A[: A.index(block)]):
-                    if (
-                        b.position == block.position
-                        and b.sub_position == block.sub_position - 1
-                    ):
-                        prev_block = b.content
-                        break
+                j = seen_segment.get((block.position, block.sub_position - 1))
             else:
-                for b in reversed(A[: A.index(block)]):
-                    if b.position == block.position - 1:
-                        prev_block = b.content
-                        break
-            for b in A[A.index(block) + 1 :]:
-                if (
-                    b.position == block.position
-                    and b.sub_position == block.sub_position + 1
-                ):
-                    next_block = b.content
-                    break
-                elif b.position == block.position + 1:
-                    next_block = b.content
-                    break
-            translated_content = replace_inline_formula(
-                block.content, placeholder_counter, placeholders
+                j = seen_position.get(block.position - 1)
+            if j is not None:
+                prev_texts[i] = A[j].content
+        seen_segment[(block.position, block.sub_position)] = i
+        seen_position[block.position] = i
+
+    # Backward pass: nearest later block matching either neighbour rule
+    seen_segment = {}
+    seen_position = {}
+    for i in range(len(A) - 1, -1, -1):
+        block = A[i]
+        if block.type == "text":
+            candidates = [
+                j
+                for j in (
+                    seen_segment.get((block.position, block.sub_position + 1)),
+                    seen_position.get(block.position + 1),
+                )
+                if j is not None
+            ]
+            if candidates:
+                next_texts[i] = A[min(candidates)].content
+        seen_segment[(block.position, block.sub_position)] = i
+        seen_position[block.position] = i
+
+    return list(zip(prev_texts, next_texts))
+
+
+INLINE_FORMULA_PATTERN = re.compile(r"\$[^$]+\$")
+PLACEHOLDER_PATTERN = re.compile(r"⚛️(\d+)⚛️")
+# Placeholders as translators tend to mangle them, e.g. "⚛ 1 ⚛" or "⚛️⚛️"
+LOOSE_PLACEHOLDER_PATTERN = re.compile(r"⚛\ufe0f?\s*(\d*)\s*⚛\ufe0f?")
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[。？！.!?;；])")
+FORMULA_SPACES_PATTERN = re.compile(r"\$\s*(.*?)\s*\$")
+
+
+def mask_inline_formulas(text: str) -> Tuple[str, List[str]]:
+    """Replace the inline formulas of a block with numbered placeholders
+
+    Placeholders are numbered from 1 within each block, so the masked text of a
+    block does not depend on the rest of the document.
+
+    Returns:
+        Tuple[str, List[str]]: The masked text and the formulas, placeholder
+                               ``⚛️n⚛️`` standing for ``formulas[n - 1]``
+    """
+    formulas = []
+
+    def replacer(match):
+        formulas.append(match.group())
+        return f"⚛️{len(formulas)}⚛️"
+
+    return INLINE_FORMULA_PATTERN.sub(replacer, text), formulas
+
+
+def restore_inline_formulas(text: str, formulas: List[str]) -> str:
+    """Put the formulas of a block back in place of its placeholders
+
+    Placeholders that do not belong to the block are left untouched.
+    """
+    if not formulas:
+        return text
+
+    def replacer(match):
+        index = int(match.group(1))
+        if not 1 <= index <= len(formulas):
+            return match.group()
+        # Remove spaces between $ and formula content
+        return " " + FORMULA_SPACES_PATTERN.sub(r"$\1$", formulas[index - 1]) + " "
+
+    return PLACEHOLDER_PATTERN.sub(replacer, text)
+
+
+def placeholders_lost(text: str, count: int) -> bool:
+    """Tell whether a translation lost, repeated or mangled any of the placeholders"""
+    found = collections.Counter(int(i) for i in PLACEHOLDER_PATTERN.findall(text))
+    # A repeated placeholder would put its formula back twice
+    if any(found[i] != 1 for i in range(1, count + 1)):
+        return True
+    return "⚛" in PLACEHOLDER_PATTERN.sub("", text)
+
+
+def repair_placeholders(text: str, count: int) -> Optional[str]:
+    """Recover placeholders the translator mangled
+
+    Markers whose number is intact keep it; the others are given the missing
+    numbers in order of appearance. This only works when there are as many
+    mangled markers as missing numbers, a formula dropped altogether cannot be
+    placed back.
+
+    Returns:
+        Optional[str]: The text with well-formed placeholders, or None if it
+                       cannot be repaired
+    """
+    ids = []
+    for match in LOOSE_PLACEHOLDER_PATTERN.finditer(text):
+        index = int(match.group(1)) if match.group(1) else None
+        if index is not None and (not 1 <= index <= count or index in ids):
+            index = None
+        ids.append(index)
+    missing = [i for i in range(1, count + 1) if i not in ids]
+    if ids.count(None) != len(missing):
+        return None
+    fill = iter(missing)
+    ids = iter([next(fill) if index is None else index for index in ids])
+    repaired = LOOSE_PLACEHOLDER_PATTERN.sub(lambda m: f"⚛️{next(ids)}⚛️", text)
+    if placeholders_lost(repaired, count):
+        return None
+    return repaired
+
+
+def async_translate(translate: callable, executor=None) -> callable:
+    """Return a coroutine version of a translate function
+
+    Translators defined with ``async def`` are returned unchanged, plain
+    functions are run in the given executor so they do not block the event loop.
+    """
+    if inspect.iscoroutinefunction(translate):
+        return translate
+
+    @functools.wraps(translate)
+    async def translate_in_executor(text: str, prev_text: str, next_text: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, translate, text, prev_text, next_text
+        )
+
+    def in_executor(func: callable) -> callable:
+        async def run_in_executor(*args):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, func, *args)
+
+        return run_in_executor
+
+    # Optional methods of the translator are plain functions as well
+    for name in ("translate_batch", "translate_strict", "translate_with_reference"):
+        method = getattr(translate, name, None)
+        if method is not None:
+            setattr(translate_in_executor, name, in_executor(method))
+
+    return translate_in_executor
+
+
+async def close_translator(translate: callable) -> None:
+    """Close the pooled client a translator holds for the running event loop, if any"""
+    aclose = getattr(translate, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+def run_translate(
+    translate: callable, text: str, prev_text: str = "", next_text: str = ""
+) -> str:
+    """Translate a single text outside of an event loop, e.g. to test a translator"""
+    if not inspect.iscoroutinefunction(translate):
+        return translate(text, prev_text, next_text)
+
+    async def run():
+        try:
+            return await translate(text, prev_text, next_text)
+        finally:
+            await close_translator(translate)
+
+    return asyncio.run(run())
+
+
+def cached_translate(translate: callable, cache=None, lookup: bool = True) -> callable:
+    """Wrap an async translate function so that results are looked up in / stored to the cache
+
+    The translator must expose a ``cache_namespace`` attribute identifying its
+    settings, otherwise the cache is bypassed. A ``translate_batch`` attribute
+    is wrapped as well, so only the texts missing from the cache are sent.
+    With ``lookup=False`` results are only stored, for texts the caller
+    already looked up.
+    """
+    namespace = getattr(translate, "cache_namespace", None)
+    if cache is None or namespace is None:
+        return translate
+
+    @functools.wraps(translate)
+    async def translate_with_cache(text: str, prev_text: str, next_text: str) -> str:
+        cached = cache.get(namespace, text, prev_text, next_text) if lookup else None
+        if cached is not None:
+            return cached
+        translated = await translate(text, prev_text, next_text)
+        # Translators return the source text on failure, do not cache that
+        if translated != text:
+            cache.set(namespace, text, prev_text, next_text, translated)
+        return translated
+
+    translate_batch = getattr(translate, "translate_batch", None)
+    if translate_batch is not None:
+
+        async def translate_batch_with_cache(
+            texts: List[str], prev_text: str = "", next_text: str = ""
+        ) -> List[str]:
+            # Batched texts are cached without context, like the per-item result
+            results = [
+                cache.get(namespace, text, "", "") if lookup else None for text in texts
+            ]
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                translated = await translate_batch(
+                    [texts[i] for i in missing], prev_text, next_text
+                )
+                if translated is None:
+                    translated = [None] * len(missing)
+                for i, result in zip(missing, translated):
+                    results[i] = result
+                    if result is not None and result != texts[i]:
+                        cache.set(namespace, texts[i], "", "", result)
+            return results
+
+        translate_with_cache.translate_batch = translate_batch_with_cache
+
+    return translate_with_cache
+
+
+def pack_batches(
+    jobs: List[tuple], batch_size: int, batch_chars: int
+) -> List[List[tuple]]:
+    """Group consecutive translation jobs into batches within the provider limits
+
+    Args:
+        jobs: (block, text, prev_text, next_text, ...) tuples in document order
+        batch_size: Maximum number of texts per batch
+        batch_chars: Maximum total characters per batch, None for no limit
+
+    Returns:
+        List[List[tuple]]: The batches, in document order
+    """
+    batches = []
+    current = []
+    current_chars = 0
+    for job in jobs:
+        chars = len(job[1])
+        if current and (
+            len(current) >= batch_size
+            or (batch_chars is not None and current_chars + chars > batch_chars)
+        ):
+            batches.append(current)
+            current = []
+            current_chars = 0
+        current.append(job)
+        current_chars += chars
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def translate_blocks(
+    A: List[Block],
+    translate: callable,
+    thread: int,
+    cache=None,
+    journal=None,
+    memory=None,
+    semaphore: asyncio.Semaphore = None,
+):
+    """Translate all blocks concurrently, yielding them in document order as they complete
+
+    At most `thread` requests are in flight. Requests are only scheduled a
+    limited number of batches ahead of the next block to yield, so the blocks
+    waiting in this reorder buffer stay bounded however long the document is.
+
+    If the translator has a ``translate_batch(texts, prev_text, next_text)``
+    attribute, consecutive blocks are packed into batches of at most
+    ``translate.batch_size`` texts and ``translate.batch_chars`` characters and
+    each batch is sent as a single request. Blocks for which ``translate_batch``
+    returns None (or a whole batch returning None) are translated one by one.
+
+    Each finished block is appended to the journal, if given, and blocks already
+    found in the journal are not sent again.
+
+    Blocks missing from the cache but found in the translation memory, if
+    given, are not sent either. A similar block found there is passed to
+    ``translate.translate_with_reference`` along with its translation, when the
+    translator has that attribute. Every translated block is added to the memory.
+
+    Identical blocks (the same title, or the same text once its formulas are
+    masked) are translated once, with the context of their first occurrence,
+    and the translation is reused for every repeat.
+
+    Args:
+        A: Blocks as returned by split_text_blocks
+        translate: The translate function, either ``async def`` or a plain function
+        thread: Maximum number of concurrent translation requests
+        cache: Optional TranslateCache to consult before calling the translator
+        journal: Optional TranslateJournal recording the finished blocks
+        memory: Optional TranslationMemory shared across documents
+        semaphore: Semaphore limiting the requests in flight, to share the
+                   limit of `thread` requests with other calls
+
+    Yields:
+        Tuple[int, Block]: The index of each block in A and the translated block
+    """
+    journal_keys = {}
+    executor = None
+    if not inspect.iscoroutinefunction(translate):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=thread)
+    batch_size = getattr(translate, "batch_size", 1)
+    batch_chars = getattr(translate, "batch_chars", None)
+    namespace = getattr(translate, "cache_namespace", None)
+    if namespace is None:
+        # Like the cache, the memory needs to know the translator settings
+        memory = None
+    translate = async_translate(translate, executor)
+    # Blocks are looked up in the cache before the memory, and only the
+    # misses are sent, so those only need their translation stored
+    lookup = cache is not None and namespace is not None
+    send = cached_translate(translate, cache, lookup=False)
+    translate = cached_translate(translate, cache)
+    translate_batch = getattr(send, "translate_batch", None)
+    translate_strict = getattr(translate, "translate_strict", None)
+    translate_with_reference = getattr(translate, "translate_with_reference", None)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(thread)
+    # How often each tier of formula recovery was needed
+    recovery = {"repaired": 0, "retried": 0, "sentences": 0}
+    # Repeats of each block translated once, by (position, sub_position)
+    duplicates = {}
+
+    async def limited_translate(text: str, prev_text: str, next_text: str) -> str:
+        async with semaphore:
+            return await translate(text, prev_text, next_text)
+
+    async def limited_send(text: str, prev_text: str, next_text: str) -> str:
+        async with semaphore:
+            return await send(text, prev_text, next_text)
+
+    def remember(job: tuple, translated: str):
+        # Translators return the source text on failure, do not remember that
+        if memory is not None and translated != job[1]:
+            memory.add(namespace, job[1], translated)
+
+    async def recover_formulas(job: tuple, translated: str) -> str:
+        block, text, prev_text, next_text, formulas, _ = job
+        if not placeholders_lost(translated, len(formulas)):
+            remember(job, translated)
+            return restore_inline_formulas(translated, formulas)
+        # Tier 1: put mangled placeholders back in place, no request needed
+        repaired = repair_placeholders(translated, len(formulas))
+        if repaired is not None:
+            recovery["repaired"] += 1
+            remember(job, repaired)
+            return restore_inline_formulas(repaired, formulas)
+        # Tier 2: one retry insisting on the placeholders, if the translator can
+        if translate_strict is not None:
+            async with semaphore:
+                retried = await translate_strict(text, prev_text, next_text)
+            if retried == text:
+                # The request failed and returned the masked source unchanged
+                retried = None
+            elif placeholders_lost(retried, len(formulas)):
+                retried = repair_placeholders(retried, len(formulas))
+            if retried is not None:
+                recovery["retried"] += 1
+                remember(job, retried)
+                return restore_inline_formulas(retried, formulas)
+        # Tier 3: translate the sentences with their formulas, concurrently
+        recovery["sentences"] += 1
+        sentences = SENTENCE_SPLIT_PATTERN.split(block.content)
+        translated_sentences = await asyncio.gather(
+            *(translate_sentence(s) for s in sentences)
+        )
+        return "".join(translated_sentences)
+
+    async def translate_sentence(sentence: str) -> str:
+        if not sentence.strip():
+            return sentence
+        return await limited_translate(sentence, "", "")
+
+    async def finish_block(job: tuple, translated: str):
+        block = job[0]
+        # Repeats restore their own formulas into the same translation
+        for duplicate in duplicates.pop((block.position, block.sub_position), []):
+            await finish_block(duplicate, translated)
+        if block.type == "text":
+            translated = await recover_formulas(job, translated)
+        else:
+            remember(job, translated)
+        block.content = translated
+        if journal is not None:
+            key = journal_keys[(block.position, block.sub_position)]
+            journal.record(key, translated)
+        progress.update(1)
+
+    async def run_job(job: tuple):
+        _, text, prev_text, next_text, _, reference = job
+        if reference is None:
+            translated = await limited_send(text, prev_text, next_text)
+        else:
+            async with semaphore:
+                translated = await translate_with_reference(
+                    text, prev_text, next_text, *reference
+                )
+        await finish_block(job, translated)
+
+    async def run_batch(batch: List[tuple]):
+        if not batching:
+            await run_job(batch[0])
+            return
+        async with semaphore:
+            results = await translate_batch(
+                [job[1] for job in batch], batch[0][2], batch[-1][3]
             )
-            placeholder_counter += len(placeholders)
-            translated = translate(
-                translated_content, prev_block or "", next_block or ""
+        if results is None or len(results) != len(batch):
+            results = [None] * len(batch)
+        # Blocks the batch could not translate are sent one by one
+        await asyncio.gather(
+            *(
+                run_job(job) if translated is None else finish_block(job, translated)
+                for job, translated in zip(batch, results)
+            )
+        )
+
+    batching = translate_batch is not None and batch_size > 1
+    contexts = build_context_index(A)
+    progress = tqdm(total=len(A), desc="Translating blocks", unit="block")
+
+    # Mask formulas and collect what needs to be translated, in document order
+    jobs = []
+    job_blocks = []
+    # First occurrence of each block to translate, and the block each repeat uses
+    representatives = {}
+    duplicate_of = {}
+    # Translations of the blocks served from the cache or the memory
+    reused = {}
+    for i, (block, (prev_text, next_text)) in enumerate(zip(A, contexts)):
+        if journal is not None and block.type in ("title", "text"):
+            key = journal.make_key(
+                block.position, block.sub_position, block.type, block.content
             )
-            for placeholder, formula in placeholders.items():
-                # Remove spaces between $ and formula content
-                formula = re.sub(r"\$\s*(.*?)\s*\$", r"$\1$", formula)
-                translated = translated.replace(placeholder, f" {formula} ")
-            if "⚛️" in translated:
-                sentences = re.split(r"(?<=[。？！.!?;；])", block.content)
-                translated_sentences = [translate(s, "", "") for s in sentences]
-                translated = "".join(translated_sentences)
-            block.content = translated
-            return block
-        return block
-
-    total_blocks = len(A)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
-        A = list(
-            tqdm(
-                executor.map(process_block, A),
-                total=total_blocks,
-                desc="Translating blocks",
-                unit="block",
+            done = journal.get(key)
+            if done is not None:
+                block.content = done
+                progress.update(1)
+                continue
+            journal_keys[(block.position, block.sub_position)] = key
+        if block.type == "title":
+            job = (block, block.content.lstrip("#").strip(), "", "", [], None)
+        elif block.type == "text":
+            masked, formulas = mask_inline_formulas(block.content)
+            job = (block, masked, prev_text, next_text, formulas, None)
+        else:
+            progress.update(1)
+            continue
+        representative = representatives.get((block.type, job[1]))
+        if representative is not None:
+            key = (representative[0].position, representative[0].sub_position)
+            duplicates.setdefault(key, []).append(job)
+            duplicate_of[i] = representative[1]
+            continue
+        translated = reused.get((block.type, job[1]))
+        if translated is not None:
+            await finish_block(job, translated)
+            continue
+        if lookup:
+            # Batched blocks are cached without their context
+            context = ("", "") if batching else job[2:4]
+            cached = cache.get(namespace, job[1], *context)
+            if cached is not None:
+                reused[(block.type, job[1])] = cached
+                await finish_block(job, cached)
+                continue
+        if memory is not None:
+            match = memory.lookup(
+                namespace, job[1], fuzzy=translate_with_reference is not None
             )
+            if match is not None and match[0] == 1.0:
+                reused[(block.type, job[1])] = match[2]
+                await finish_block(job, match[2])
+                continue
+            if match is not None:
+                job = job[:5] + (match[1:],)
+        representatives[(block.type, job[1])] = (block, i)
+        jobs.append(job)
+        job_blocks.append(i)
+    del contexts, representatives, reused
+    if duplicate_of:
+        print(
+            f"Deduplication: {len(duplicate_of)} repeated blocks reuse the "
+            "translation of an identical block instead of being sent again"
         )
-    return A
 
+    if batching:
+        batches = pack_batches(jobs, batch_size, batch_chars)
+    else:
+        batches = [[job] for job in jobs]
+    del jobs
+    # Index of the batch translating each block
+    batch_of_block = {}
+    job_index = 0
+    for b, batch in enumerate(batches):
+        for _ in batch:
+            batch_of_block[job_blocks[job_index]] = b
+            job_index += 1
+    # Repeats are done once the batch of their first occurrence is
+    for i, representative in duplicate_of.items():
+        batch_of_block[i] = batch_of_block[representative]
+    del duplicate_of
 
-def combine_blocks(A: List[Block]) -> str:
-    combined = []
-    special_types = ["table", "block_formula", "image", "link_image", "link"]
-    for i, block in enumerate(A):
-        # Add newline before special blocks
-        if block.type in special_types and (
-            i == 0 or A[i - 1].type not in special_types
-        ):
-            combined.append("\n")
+    window = max(thread * 4, 16)
+    tasks = {}
+    scheduled = 0
+    try:
+        for i, block in enumerate(A):
+            b = batch_of_block.get(i)
+            if b is not None:
+                while scheduled < min(b + window, len(batches)):
+                    tasks[scheduled] = asyncio.ensure_future(
+                        run_batch(batches[scheduled])
+                    )
+                    scheduled += 1
+                # The batch of a repeated block may already have been released
+                if b in tasks:
+                    await tasks[b]
+                # Release batches whose blocks have all been yielded
+                for done in [k for k in tasks if k < b]:
+                    del tasks[done]
+                    batches[done] = None
+            yield i, block
+        if any(recovery.values()):
+            print(
+                f"Formula placeholders lost in {sum(recovery.values())} blocks: "
+                f"{recovery['repaired']} repaired, {recovery['retried']} retried, "
+                f"{recovery['sentences']} translated sentence by sentence"
+            )
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        progress.close()
+        if executor is not None:
+            executor.shutdown(wait=False)
 
-        combined.append(block.content)
 
-        # Add newline after special blocks
-        if block.type in special_types and (
-            i == len(A) - 1 or A[i + 1].type not in special_types
-        ):
-            combined.append("\n")
+async def concurrent_translate(
+    A: List[Block],
+    translate: callable,
+    thread: int,
+    cache=None,
+    journal=None,
+    memory=None,
+    semaphore: asyncio.Semaphore = None,
+) -> List[Block]:
+    """Translate all blocks concurrently, with at most `thread` requests in flight
 
-    return "".join(combined)
+    See translate_blocks for batching, journaling and the translation memory.
 
+    Returns:
+        List[Block]: The translated blocks, in document order
+    """
+    async for _ in translate_blocks(
+        A, translate, thread, cache, journal, memory, semaphore
+    ):
+        pass
+    return A
 
-def process_markdown(input_markdown: str, translate: callable, thread: int = 10) -> str:
-    # Preprocess markdown content
-    pattern1 = re.compile(
-        r"\\begin{center}\s*\\adjustbox{max width=\\textwidth}{\s*(.*?)\s*\\end{tabular}\s*}\s*\\end{center}",
-        re.DOTALL,
-    )
-    replacement1 = r"\\begin{center}\n\1\n\\end{tabular}\n\\end{center}"
-    input_markdown = re.sub(pattern1, replacement1, input_markdown)
 
-    pattern2 = re.compile(r"\\tag\{(.*?)\}")
-    replacement2 = r"\\qquad \\text{(\1)}"
-    input_markdown = re.sub(pattern2, replacement2, input_markdown)
+SPECIAL_TYPES = ["table", "block_formula", "image", "link_image", "link"]
 
-    # Remove media and footnote comments
-    input_markdown = re.sub(r"<!-- Media -->\n?", "", input_markdown)
-    input_markdown = re.sub(r"<!-- Footnote -->\n?", "", input_markdown)
 
-    # Replace \( \) with $ and \[ \] with $$ for math expressions
-    input_markdown = re.sub(r"\\[()]", "$", input_markdown)
-    input_markdown = re.sub(r"\\[\[\]]", "$$", input_markdown)
+def block_text(A: List[Block], i: int) -> str:
+    """Return the output text of block i, as it appears in the combined document"""
+    block = A[i]
+    if block.type not in SPECIAL_TYPES:
+        return block.content
+    combined = []
+    # Add newline before special blocks
+    if i == 0 or A[i - 1].type not in SPECIAL_TYPES:
+        combined.append("\n")
+    combined.append(block.content)
+    # Add newline after special blocks
+    if i == len(A) - 1 or A[i + 1].type not in SPECIAL_TYPES:
+        combined.append("\n")
+    return "".join(combined)
 
-    # Replace $$$$ with $$\n$$ for better readability
-    input_markdown = re.sub(r"\$\$\$\$", "$$\n$$", input_markdown)
+
+def combine_blocks(A: List[Block]) -> str:
+    return "".join(block_text(A, i) for i in range(len(A)))
+
+
+def prepare_blocks(input_markdown: str, translate: callable) -> List[Block]:
+    """Normalise the markdown and split it into blocks sized for the translator"""
+    input_markdown = preprocess_markdown(input_markdown)
 
     # Process blocks
     blocks = split_markdown(input_markdown)
-    blocks = split_text_blocks(blocks)
-    blocks = concurrent_translate(A=blocks, translate=translate, thread=thread)
+    return split_text_blocks(
+        blocks, max_tokens=getattr(translate, "chunk_tokens", DEFAULT_CHUNK_TOKENS)
+    )
+
+
+def process_markdown(
+    input_markdown: str,
+    translate: callable,
+    thread: int = 10,
+    cache=None,
+    journal=None,
+    memory=None,
+) -> str:
+    blocks = prepare_blocks(input_markdown, translate)
+
+    async def run():
+        try:
+            return await concurrent_translate(
+                A=blocks,
+                translate=translate,
+                thread=thread,
+                cache=cache,
+                journal=journal,
+                memory=memory,
+            )
+        finally:
+            await close_translator(translate)
+
+    blocks = asyncio.run(run())
     output_markdown = combine_blocks(blocks)
     return output_markdown
+
+
+def stream_markdown(
+    input_markdown: str,
+    output_file,
+    translate: callable,
+    thread: int = 10,
+    cache=None,
+    journal=None,
+    memory=None,
+) -> None:
+    """Translate markdown and write it to output_file block by block
+
+    Blocks are written in document order as soon as they and all blocks before
+    them are translated, so the output can be watched while a long job runs and
+    the translated document is never held in memory as a whole.
+
+    Args:
+        input_markdown: The markdown to translate
+        output_file: A text file opened for writing
+        translate: The translate function
+        thread: Maximum number of concurrent translation requests
+        cache: Optional TranslateCache to consult before calling the translator
+        journal: Optional TranslateJournal recording the finished blocks
+        memory: Optional TranslationMemory shared across documents
+    """
+    blocks = prepare_blocks(input_markdown, translate)
+    del input_markdown
+
+    async def run():
+        try:
+            async for i, block in translate_blocks(
+                blocks, translate, thread, cache, journal, memory
+            ):
+                output_file.write(block_text(blocks, i))
+                output_file.flush()
+                # Only the type of a written block is still needed, by its neighbours
+                block.content = ""
+        finally:
+            await close_translator(translate)
+
+    asyncio.run(run())
+
+
+async def stream_markdown_pages(
+    pages: AsyncIterator[str],
+    output_file,
+    translate: callable,
+    thread: int = 10,
+    cache=None,
+    journal=None,
+    memory=None,
+) -> List[str]:
+    """Translate markdown arriving page by page and write it to output_file in order
+
+    Every page is split into blocks and translated as soon as it arrives, while
+    the next pages are still being converted. All pages share the limit of
+    `thread` requests in flight. Pages are written in order, as soon as they
+    and all pages before them are translated, separated by a newline like the
+    pages of a whole conversion.
+
+    Args:
+        pages: Async iterator of the markdown of each page, in page order
+        output_file: A text file opened for writing
+        translate: The translate function
+        thread: Maximum number of concurrent translation requests
+        cache: Optional TranslateCache to consult before calling the translator
+        journal: Optional TranslateJournal recording the finished blocks
+        memory: Optional TranslationMemory shared across documents
+
+    Returns:
+        List[str]: The source markdown of every page
+    """
+    semaphore = asyncio.Semaphore(thread)
+    translating = asyncio.Queue()
+    sources = []
+
+    async def read_pages():
+        # Blocks are numbered across pages, so journal keys stay unique
+        offset = 0
+        try:
+            async for page in pages:
+                sources.append(page)
+                blocks = prepare_blocks(page, translate)
+                for block in blocks:
+                    block.position += offset
+                if blocks:
+                    offset = blocks[-1].position
+                task = asyncio.ensure_future(
+                    concurrent_translate(
+                        blocks, translate, thread, cache, journal, memory, semaphore
+                    )
+                )
+                await translating.put(task)
+        finally:
+            await translating.put(None)
+
+    reader = asyncio.ensure_future(read_pages())
+    task = None
+    try:
+        first = True
+        while True:
+            task = await translating.get()
+            if task is None:
+                break
+            blocks = await task
+            if not first:
+                output_file.write("\n")
+            output_file.write(combine_blocks(blocks))
+            output_file.flush()
+            first = False
+        # Raise the conversion error that ended the pages, if any
+        await reader
+    finally:
+        reader.cancel()
+        if task is not None:
+            task.cancel()
+        while not translating.empty():
+            task = translating.get_nowait()
+            if task is not None:
+                task.cancel()
+        await close_translator(translate)
+    return sources
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def pool_limits(pool_size: int = 10) -> httpx.Limits:
+    """Connection pool limits for a translator issuing up to pool_size concurrent requests"""
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+
+
+class ClientPool:
+    """Hold one long-lived HTTP client per event loop for a translator
+
+    Async HTTP clients are bound to the event loop they were first used in, so
+    the pool lazily creates a client for each running loop and reuses it for
+    every request made from that loop. Connections (and their TCP/TLS
+    handshakes) are therefore shared by all blocks of a document.
+
+    The pool can be used as an async context manager, which closes the client
+    of the current loop on exit.
+    """
+
+    def __init__(self, create: callable, close: callable = None):
+        """
+        Args:
+            create: Function returning a new client
+            close: Async function closing a client, defaults to calling ``client.aclose()``
+        """
+        self._create = create
+        self._close = close
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the client for the running event loop, creating it if needed"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                # Forget clients of loops that are gone, they cannot be reused
+                for old_loop in [k for k in self._clients if k.is_closed()]:
+                    del self._clients[old_loop]
+                client = self._create()
+                self._clients[loop] = client
+            return client
+
+    async def aclose(self) -> None:
+        """Close the client of the running event loop, if any"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.pop(loop, None)
+        if client is None:
+            return
+        if self._close is not None:
+            await self._close(client)
+        else:
+            await client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
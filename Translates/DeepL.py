@@ -1,36 +1,83 @@
 import httpx
 import json
+from typing import List, Optional
+from Translates.Client import ClientPool, pool_limits, HTTP2_AVAILABLE
+from Translates.RateLimit import RateLimiter
 
 
-def deepl_translate(api_key: str, dest: str = "ZH") -> callable:
+def deepl_translate(
+    api_key: str, dest: str = "ZH", pool_size: int = 10, limiter: RateLimiter = None
+) -> callable:
     """Initialize and return the translate function using DeepL API
 
     Args:
         api_key: The DeepL API authentication key
         dest: Destination language code, defaults to "ZH"
+        pool_size: Maximum number of pooled HTTP connections, usually the number of threads
+        limiter: RateLimiter shared by all requests, defaults to one allowing pool_size concurrent requests
 
     Returns:
-        callable: The translate function that can be used for translation
+        callable: The translate function that can be used for translation,
+                  ``translate.translate_batch(texts)`` translates several texts in
+                  one request, returning None on failure, and ``await translate.aclose()`` closes its pooled client
     """
+    if limiter is None:
+        limiter = RateLimiter(max_concurrency=pool_size)
+    client_pool = ClientPool(
+        lambda: httpx.AsyncClient(
+            timeout=10.0, limits=pool_limits(pool_size), http2=HTTP2_AVAILABLE
+        )
+    )
 
-    def translate(text: str, prev_text: str, next_text: str) -> str:
-        try:
-            deepl_api = "https://api.deepl.com/v2/translate"
-            headers = {
-                "Authorization": f"DeepL-Auth-Key {api_key}",
-                "Content-Type": "application/json",
-            }
-            data = {"text": [text], "target_lang": dest}
-            post_data = json.dumps(data)
-            response = httpx.post(
-                url=deepl_api, headers=headers, data=post_data, timeout=10.0
+    deepl_api = "https://api.deepl.com/v2/translate"
+    headers = {
+        "Authorization": f"DeepL-Auth-Key {api_key}",
+        "Content-Type": "application/json",
+    }
+
+    async def translate_batch(
+        texts: List[str], prev_text: str = "", next_text: str = ""
+    ) -> Optional[List[str]]:
+        data = {"text": texts, "target_lang": dest}
+        post_data = json.dumps(data)
+
+        async def request():
+            response = await client_pool.get().post(
+                url=deepl_api, headers=headers, data=post_data
             )
             if response.status_code != 200:
-                raise Exception(f"HTTP request failed: {response.text}")
+                raise httpx.HTTPStatusError(
+                    f"HTTP request failed: {response.text}",
+                    request=response.request,
+                    response=response,
+                )
+            return response
+
+        try:
+            response = await limiter.call(request)
             result = json.loads(response.text)
-            return result["translations"][0]["text"]
+            translations = [
+                translation["text"] for translation in result["translations"]
+            ]
         except Exception as e:
             print(f"Error: {e}")
-            return text
+            # None lets the caller fall back to translating the blocks one by one
+            return None
+        if len(translations) != len(texts):
+            return None
+        return translations
+
+    async def translate(text: str, prev_text: str, next_text: str) -> str:
+        translations = await translate_batch([text])
+        return text if translations is None else translations[0]
 
+    translate.cache_namespace = json.dumps(["deepl", dest], ensure_ascii=False)
+    # DeepL accepts up to 50 texts and 128 KiB per request
+    translate.translate_batch = translate_batch
+    translate.batch_size = 50
+    translate.batch_chars = 30000
+    translate.chunk_tokens = 1024
+    translate.limiter = limiter
+    translate.client_pool = client_pool
+    translate.aclose = client_pool.aclose
     return translate
@@ -1,9 +1,15 @@
 import httpx
 import json
+from Translates.Client import ClientPool, pool_limits, HTTP2_AVAILABLE
+from Translates.RateLimit import RateLimiter
 
 
 def deeplx_translate(
-    base_url="http://127.0.0.1:1188/translate", src: str = "EN", dest: str = "ZH"
+    base_url="http://127.0.0.1:1188/translate",
+    src: str = "EN",
+    dest: str = "ZH",
+    pool_size: int = 10,
+    limiter: RateLimiter = None,
 ) -> callable:
     """Initialize and return the translate function using DeepLX API
 
@@ -11,23 +17,50 @@ def deeplx_translate(
         base_url: The base URL of the DeepLX API, defaults to "http://127.0.0.1:1188/translate"
         src: Source language code, defaults to "EN"
         dest: Destination language code, defaults to "ZH"
+        pool_size: Maximum number of pooled HTTP connections, usually the number of threads
+        limiter: RateLimiter shared by all requests, defaults to one allowing pool_size concurrent requests
 
     Returns:
-        callable: The translate function that can be used for translation
+        callable: The translate function that can be used for translation,
+                  ``await translate.aclose()`` closes its pooled client
     """
+    if limiter is None:
+        limiter = RateLimiter(max_concurrency=pool_size)
+    client_pool = ClientPool(
+        lambda: httpx.AsyncClient(
+            timeout=10.0, limits=pool_limits(pool_size), http2=HTTP2_AVAILABLE
+        )
+    )
 
-    def translate(text: str, prev_text: str, next_text: str) -> str:
+    async def translate(text: str, prev_text: str, next_text: str) -> str:
         try:
             deeplx_api = base_url
             data = {"text": text, "source_lang": src, "target_lang": dest}
             post_data = json.dumps(data)
-            response = httpx.post(url=deeplx_api, data=post_data, timeout=10.0)
-            if response.status_code != 200:
-                raise Exception(f"HTTP request failed: {response.text}")
+
+            async def request():
+                response = await client_pool.get().post(url=deeplx_api, data=post_data)
+                if response.status_code != 200:
+                    raise httpx.HTTPStatusError(
+                        f"HTTP request failed: {response.text}",
+                        request=response.request,
+                        response=response,
+                    )
+                return response
+
+            response = await limiter.call(request)
             result = json.loads(response.text)
             return result["data"]
         except Exception as e:
             print(f"Error: {e}")
             return text
 
+    translate.cache_namespace = json.dumps(
+        ["deeplx", base_url, src, dest], ensure_ascii=False
+    )
+    # Keep requests well below the 5000 character limit of the DeepL web API
+    translate.chunk_tokens = 1000
+    translate.limiter = limiter
+    translate.client_pool = client_pool
+    translate.aclose = client_pool.aclose
     return translate
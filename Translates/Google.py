@@ -1,28 +1,44 @@
 from googletrans import Translator
+from Translates.Client import ClientPool, HTTP2_AVAILABLE
+from Translates.RateLimit import RateLimiter
+import json
 
 
-def google_translate(src: str = "en", dest: str = "zh-cn") -> callable:
+def google_translate(
+    src: str = "en", dest: str = "zh-cn", limiter: RateLimiter = None
+) -> callable:
     """Initialize and return the translate function
 
     Args:
         src: Source language code, defaults to "en"
         dest: Destination language code, defaults to "zh-cn"
+        limiter: RateLimiter shared by all requests, defaults to one allowing 10 concurrent requests
 
     Returns:
-        callable: The translate function that can be used for translation
+        callable: The translate function that can be used for translation,
+                  ``await translate.aclose()`` closes its pooled client
     """
+    if limiter is None:
+        limiter = RateLimiter()
+    client_pool = ClientPool(
+        lambda: Translator(http2=HTTP2_AVAILABLE),
+        close=lambda T: T.client.aclose(),
+    )
 
-    def translate(text: str, prev_text: str, next_text: str) -> str:
+    async def translate(text: str, prev_text: str, next_text: str) -> str:
         try:
-            T = Translator()
-            import asyncio
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(T.translate(text, src=src, dest=dest))
-            loop.close()
+            result = await limiter.call(
+                lambda: client_pool.get().translate(text, src=src, dest=dest)
+            )
             return result.text
         except Exception as e:
             print(f"Error: {e}")
             return text
 
+    translate.cache_namespace = json.dumps(["google", src, dest], ensure_ascii=False)
+    # The Google web API rejects texts over 5000 characters
+    translate.chunk_tokens = 1000
+    translate.limiter = limiter
+    translate.client_pool = client_pool
+    translate.aclose = client_pool.aclose
     return translate
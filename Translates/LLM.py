@@ -0,0 +1,432 @@
+import json
+import re
+import threading
+from typing import List, NamedTuple, Optional, Union
+from Split_MD import count_tokens
+
+SEGMENT_PATTERN = re.compile(r'<segment id="(\d+)">(.*?)</segment>', re.DOTALL)
+
+DEFAULT_SYSTEM_PROMPT = "You are a specialized language model trained in translating Markdown documents while preserving their formatting. Your task is to translate a given Markdown text from {src} to {dest}."
+
+# Asks for a long analysis before the translation, which is then discarded
+QUALITY_INPUT_PROMPT = """
+Here are the key elements for this task:
+1. Previous text (for context):
+<previous_text>
+{{prev_text}}
+</previous_text>
+2. The language to translate into:
+<destination_language>
+{{dest}}
+</destination_language>
+3. The Markdown text to translate:
+<markdown_text>
+{{text}}
+</markdown_text>
+Instructions:
+1. Read through the Markdown text carefully.
+2. Identify all Markdown formatting elements (e.g., headers, bold, italic, links, lists).
+3. Translate only the text content, leaving all Markdown syntax unchanged.
+4. Ensure that the meaning and tone of the original text are preserved in the translation.
+5. Pay attention to any context provided by the previous text, if available.
+Before providing your final translation, wrap your analysis in <translation_analysis> tags:
+- List all Markdown elements present in the text, counting them (e.g., 1. Header, 2. Bold text, 3. Italic text, etc.).
+- Identify any culturally specific terms or idioms that might need special attention in translation.
+- Note any areas where the sentence structure might need to be significantly altered in the target language.
+- Consider how the previous text (if provided) might influence the translation.
+- Plan how to maintain the original text's structure and meaning in the target language.
+It's OK for this section to be quite long.
+After your analysis, provide the translated Markdown text. Remember:
+- Do NOT modify any existing Markdown commands.
+- Ensure that your translation accurately reflects the content and style of the original text.
+Format your output and only give as follows:
+```
+[Your translated Markdown text here, preserving all original Markdown formatting]
+```
+Please proceed with your analysis and translation.
+"""
+
+# Same instructions without the analysis
+BALANCED_INPUT_PROMPT = """
+Here are the key elements for this task:
+1. Previous text (for context):
+<previous_text>
+{{prev_text}}
+</previous_text>
+2. The language to translate into:
+<destination_language>
+{{dest}}
+</destination_language>
+3. The Markdown text to translate:
+<markdown_text>
+{{text}}
+</markdown_text>
+Instructions:
+1. Translate only the text content, leaving all Markdown syntax unchanged.
+2. Ensure that the meaning and tone of the original text are preserved in the translation.
+3. Use the previous text only as context, do not translate it.
+Do not explain anything. Format your output and only give as follows:
+```
+[Your translated Markdown text here, preserving all original Markdown formatting]
+```
+"""
+
+# Minimal prompt answered with a JSON object
+FAST_INPUT_PROMPT = """Translate the Markdown text into {{dest}}, keeping all Markdown syntax and placeholders unchanged.
+Previous text, for context only:
+<previous_text>
+{{prev_text}}
+</previous_text>
+<markdown_text>
+{{text}}
+</markdown_text>
+Answer with a JSON object of the form {"translated": "<translated Markdown text>"} and nothing else.
+"""
+
+# Input prompt, extraction type and whether to request JSON output, per profile
+PROMPT_PROFILES = {
+    "fast": (FAST_INPUT_PROMPT, "json", True),
+    "balanced": (BALANCED_INPUT_PROMPT, "markdown", False),
+    "quality": (QUALITY_INPUT_PROMPT, "markdown", False),
+}
+
+
+def resolve_prompts(
+    profile: str,
+    src: str,
+    dest: str,
+    system_prompt: str = None,
+    input_prompt: str = None,
+    extra_type: str = "markdown",
+):
+    """Pick the prompts of a profile, custom prompts taking precedence
+
+    The built-in input prompts fix their own output format, so ``extra_type``
+    only applies to a custom input prompt.
+
+    Returns:
+        Tuple[str, str, str, bool]: The system prompt, the input prompt, the
+                                    extraction type and whether the API should
+                                    be asked for a JSON object
+    """
+    if profile not in PROMPT_PROFILES:
+        raise ValueError(
+            f"prompt_profile must be one of {', '.join(PROMPT_PROFILES)}, got {profile}"
+        )
+    if system_prompt is None:
+        system_prompt = DEFAULT_SYSTEM_PROMPT.format(src=src, dest=dest)
+    if input_prompt is not None:
+        return system_prompt, input_prompt, extra_type, False
+    return (system_prompt, *PROMPT_PROFILES[profile])
+
+
+class LLMUsage:
+    """Output tokens and latency of the requests made with a prompt profile"""
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.requests = 0
+        self.output_tokens = 0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, output_tokens: int = 0) -> None:
+        with self._lock:
+            self.requests += 1
+            self.latency += latency
+            self.output_tokens += output_tokens
+
+    def summary(self) -> str:
+        requests = max(1, self.requests)
+        return (
+            f"LLM usage ({self.profile} profile): {self.requests} requests, "
+            f"{self.output_tokens} output tokens "
+            f"({self.output_tokens / requests:.0f} per request), "
+            f"{self.latency / requests:.2f}s average latency"
+        )
+
+
+STRICT_PLACEHOLDER_PROMPT = (
+    "The text contains placeholders such as ⚛️1⚛️, each standing for a formula. "
+    "Copy every placeholder into the translation exactly as written, once each, "
+    "where its formula belongs in the translated sentence. Never translate, "
+    "renumber, split or drop a placeholder."
+)
+
+
+def batch_system_prompt(system_prompt: str, count: int, extra_type: str) -> str:
+    """Extend the system prompt with instructions for a packed batch of segments"""
+    instruction = (
+        f"The text to translate is made of {count} segments, each wrapped in "
+        '<segment id="N"> and </segment> tags. Translate every segment on its own '
+    )
+    if extra_type == "json":
+        instruction += (
+            f'and return "translated" as a JSON array of exactly {count} strings, '
+            "one translated segment per element, in the same order."
+        )
+    else:
+        instruction += (
+            "and keep every tag unchanged, so the output contains the same "
+            f"{count} segments in the same order."
+        )
+    return f"{system_prompt}\n{instruction}"
+
+
+def pad_translation(text: str) -> str:
+    """Surround a translation with the newlines a fenced answer keeps
+
+    Blocks are joined without separators, so a translation extracted from
+    JSON or a segment tag would otherwise run into the next block.
+    """
+    return "\n" + text.strip("\n") + "\n"
+
+
+def pack_segments(texts: List[str]) -> str:
+    """Join several texts into one, each wrapped in a numbered segment tag"""
+    return "\n".join(
+        f'<segment id="{i}">\n{text}\n</segment>' for i, text in enumerate(texts, 1)
+    )
+
+
+def split_segments(result, count: int) -> Optional[List[str]]:
+    """Split a packed translation back into its segments
+
+    Args:
+        result: The extracted LLM output, a string with segment tags or a JSON list
+        count: The number of segments that were sent
+
+    Returns:
+        Optional[List[str]]: The translated segments, or None if the number or
+                             order of the segments does not match
+    """
+    if isinstance(result, list):
+        if len(result) != count:
+            return None
+        return [pad_translation(str(segment)) for segment in result]
+    found = SEGMENT_PATTERN.findall(result)
+    if [int(i) for i, _ in found] != list(range(1, count + 1)):
+        return None
+    return [pad_translation(segment) for _, segment in found]
+
+
+def llm_translate_batch(
+    translate: callable, system_prompt: str, extra_type: str
+) -> callable:
+    """Build a translate_batch function packing several blocks into one LLM request
+
+    Args:
+        translate: The LLM translate function, accepting a ``system`` keyword
+        system_prompt: The system prompt of the translator
+        extra_type: How the translated text is extracted from the response
+
+    Returns:
+        callable: ``translate_batch(texts, prev_text, next_text)`` returning the
+                  translations, or None when the segments could not be matched
+                  back so the caller can translate the blocks one by one
+    """
+
+    async def translate_batch(
+        texts: List[str], prev_text: str = "", next_text: str = ""
+    ) -> Optional[List[str]]:
+        packed = pack_segments(texts)
+        result = await translate(
+            packed,
+            prev_text,
+            next_text,
+            system=batch_system_prompt(system_prompt, len(texts), extra_type),
+        )
+        if result == packed:
+            # The request failed and the translator returned its input: splitting
+            # it would pass the source texts off as their translations
+            print(f"Batch of {len(texts)} blocks failed, translating them one by one")
+            return None
+        segments = split_segments(result, len(texts))
+        if segments is None:
+            print(
+                f"Batch of {len(texts)} blocks came back with mismatched segments, "
+                "translating them one by one"
+            )
+        return segments
+
+    return translate_batch
+
+
+def llm_translate_strict(translate: callable, system_prompt: str) -> callable:
+    """Build a translate_strict function, used to retry a block whose formula
+    placeholders were lost, with a system prompt insisting on keeping them
+
+    Args:
+        translate: The LLM translate function, accepting a ``system`` keyword
+        system_prompt: The system prompt of the translator
+
+    Returns:
+        callable: ``translate_strict(text, prev_text, next_text)``
+    """
+
+    async def translate_strict(
+        text: str, prev_text: str = "", next_text: str = ""
+    ) -> str:
+        return await translate(
+            text,
+            prev_text,
+            next_text,
+            system=f"{system_prompt}\n{STRICT_PLACEHOLDER_PROMPT}",
+        )
+
+    return translate_strict
+
+
+REFERENCE_PROMPT = """A similar text was translated before. Reuse its terminology and wording wherever the texts match, but translate the text exactly as given.
+<reference_source>
+{source}
+</reference_source>
+<reference_translation>
+{translation}
+</reference_translation>"""
+
+
+def llm_translate_reference(translate: callable, system_prompt: str) -> callable:
+    """Build a translate_with_reference function, passing a similar block
+    found in the translation memory, and its translation, to the model
+
+    Args:
+        translate: The LLM translate function, accepting a ``system`` keyword
+        system_prompt: The system prompt of the translator
+
+    Returns:
+        callable: ``translate_with_reference(text, prev_text, next_text,
+                  reference_source, reference_translation)``
+    """
+
+    async def translate_with_reference(
+        text: str,
+        prev_text: str,
+        next_text: str,
+        reference_source: str,
+        reference_translation: str,
+    ) -> str:
+        reference = REFERENCE_PROMPT.format(
+            source=reference_source, translation=reference_translation
+        )
+        return await translate(
+            text, prev_text, next_text, system=f"{system_prompt}\n{reference}"
+        )
+
+    return translate_with_reference
+
+
+JSON_TRANSLATED_PATTERN = re.compile(r'"translated"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def extract_translation(result: str, extra_type: str):
+    """Extract the translated text from a complete LLM response
+
+    Args:
+        result: The response text
+        extra_type: "json" for the "translated" key of a JSON object, "markdown"
+                    for the text wrapped in ```, otherwise the raw response
+
+    Returns:
+        The translated text, a list for packed JSON batches
+    """
+    if extra_type == "json":
+        try:
+            translated = json.loads(result)["translated"]
+        except Exception as e:
+            print(f"Having trouble extracting JSON: {e}")
+            return result
+        # Packed batches are lists, split and padded by split_segments
+        return (
+            translated
+            if isinstance(translated, list)
+            else pad_translation(str(translated))
+        )
+    elif extra_type == "markdown":
+        try:
+            return result[result.find("```") + 3 : result.rfind("```")]
+        except Exception as e:
+            print(f"Having trouble extracting markdown: {e}")
+            return result
+    return result
+
+
+class StreamExtractor:
+    """Collect a streamed LLM response and detect when the translation is complete
+
+    For "json" the translation is complete at the end of the "translated"
+    string, the rest of the response is then not needed and the stream can be
+    closed. For "markdown" the translation runs from the first fence to the
+    last one, as in extract_translation: a later fence could still move its
+    end, so the response is read to its end and extracted the same way.
+    """
+
+    def __init__(self, extra_type: str):
+        self.extra_type = extra_type
+        self.text = ""
+        self.payload = None
+
+    def feed(self, delta: str) -> bool:
+        """Add a chunk of the response, return True once the translation is complete"""
+        self.text += delta
+        if self.extra_type == "json":
+            match = JSON_TRANSLATED_PATTERN.search(self.text)
+            if match is not None:
+                try:
+                    self.payload = pad_translation(json.loads(f'"{match.group(1)}"'))
+                except ValueError:
+                    pass
+        return self.payload is not None
+
+    def result(self):
+        """The translation, extracted from the whole response if it never completed early"""
+        if self.payload is not None:
+            return self.payload
+        return extract_translation(self.text, self.extra_type)
+
+
+class Completion(NamedTuple):
+    result: Union[str, list]
+    output_tokens: int
+    # Reported by the API, None when the response was streamed
+    total_tokens: Optional[int]
+
+
+async def chat_completion(
+    client, extra_type: str, stream: bool = False, listener: callable = None, **kwargs
+) -> Completion:
+    """Request a chat completion and extract the translation from it
+
+    Args:
+        client: The AsyncOpenAI client
+        extra_type: How the translated text is extracted from the response
+        stream: Stream the response and close it as soon as the translation is complete
+        listener: Called with the number of characters of every streamed chunk
+        kwargs: Arguments of ``client.chat.completions.create``
+
+    Returns:
+        Completion: The extracted translation and the tokens used
+    """
+    if not stream:
+        response = await client.chat.completions.create(stream=False, **kwargs)
+        result = extract_translation(response.choices[0].message.content, extra_type)
+        if response.usage is None:
+            return Completion(result, 0, None)
+        return Completion(
+            result, response.usage.completion_tokens, response.usage.total_tokens
+        )
+
+    extractor = StreamExtractor(extra_type)
+    response = await client.chat.completions.create(stream=True, **kwargs)
+    try:
+        async for chunk in response:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            delta = chunk.choices[0].delta.content
+            if listener is not None:
+                listener(len(delta))
+            if extractor.feed(delta):
+                break
+    finally:
+        await response.close()
+    return Completion(extractor.result(), count_tokens(extractor.text), None)
@@ -1,5 +1,17 @@
-from openai import OpenAI
+from openai import NOT_GIVEN, AsyncOpenAI, DefaultAsyncHttpxClient
+from Translates.Client import ClientPool, pool_limits, HTTP2_AVAILABLE
+from Translates.LLM import (
+    LLMUsage,
+    chat_completion,
+    llm_translate_batch,
+    llm_translate_reference,
+    llm_translate_strict,
+    resolve_prompts,
+)
+from Translates.RateLimit import RateLimiter
+from Split_MD import count_tokens
 import json
+import time
 
 
 def openai_translate(
@@ -12,6 +24,12 @@ def openai_translate(
     system_prompt: str = None,
     input_prompt: str = None,
     extra_type="markdown",
+    prompt_profile: str = "quality",
+    stream: bool = False,
+    pool_size: int = 10,
+    limiter: RateLimiter = None,
+    batch_size: int = 1,
+    batch_chars: int = 4000,
 ) -> callable:
     """Initialize and return the translate function
 
@@ -23,98 +41,112 @@ def openai_translate(
                    "json": Extract from JSON format with key "translated"
                    "markdown": Extract text wrapped in ```
                    Otherwise use raw response text
+                   Only used with a custom input_prompt
+        prompt_profile: Built-in prompts to use, defaults to "quality"
+                   "fast": Short prompt answered with a JSON object
+                   "balanced": Detailed instructions without the analysis
+                   "quality": Asks the model to analyse the text before translating
+        stream: Stream responses and stop reading once the translation is complete,
+                ``translate.stream_listener`` is called with the size of every chunk
+        pool_size: Maximum number of pooled HTTP connections, usually the number of threads
+        limiter: RateLimiter shared by all requests, defaults to one allowing pool_size concurrent requests
+        batch_size: Number of adjacent blocks packed into one request, 1 disables batching
+        batch_chars: Maximum number of characters packed into one request
 
     Returns:
-        callable: The translate function that can be used for translation
+        callable: The translate function that can be used for translation,
+                  ``await translate.aclose()`` closes its pooled client
     """
-    if system_prompt is None:
-        system_prompt = f"You are a specialized language model trained in translating Markdown documents while preserving their formatting. Your task is to translate a given Markdown text from {src} to {dest}."
-    if input_prompt is None:
-        input_prompt = """
-Here are the key elements for this task:
-1. Previous text (for context):
-<previous_text>
-{{prev_text}}
-</previous_text>
-2. The language to translate into:
-<destination_language>
-{{dest}}
-</destination_language>
-3. The Markdown text to translate:
-<markdown_text>
-{{text}}
-</markdown_text>
-Instructions:
-1. Read through the Markdown text carefully.
-2. Identify all Markdown formatting elements (e.g., headers, bold, italic, links, lists).
-3. Translate only the text content, leaving all Markdown syntax unchanged.
-4. Ensure that the meaning and tone of the original text are preserved in the translation.
-5. Pay attention to any context provided by the previous text, if available.
-Before providing your final translation, wrap your analysis in <translation_analysis> tags:
-- List all Markdown elements present in the text, counting them (e.g., 1. Header, 2. Bold text, 3. Italic text, etc.).
-- Identify any culturally specific terms or idioms that might need special attention in translation.
-- Note any areas where the sentence structure might need to be significantly altered in the target language.
-- Consider how the previous text (if provided) might influence the translation.
-- Plan how to maintain the original text's structure and meaning in the target language.
-It's OK for this section to be quite long.
-After your analysis, provide the translated Markdown text. Remember:
-- Do NOT modify any existing Markdown commands.
-- Ensure that your translation accurately reflects the content and style of the original text.
-Format your output and only give as follows:
-```
-[Your translated Markdown text here, preserving all original Markdown formatting]
-```
-Please proceed with your analysis and translation.
-"""
+    usage = LLMUsage(prompt_profile if input_prompt is None else "custom")
+    system_prompt, input_prompt, extra_type, json_output = resolve_prompts(
+        prompt_profile, src, dest, system_prompt, input_prompt, extra_type
+    )
+    # Structured output spares the model any text around the translation
+    response_format = {"type": "json_object"} if json_output else NOT_GIVEN
 
     if "{{text}}" not in input_prompt:
         raise ValueError("input_prompt must contain {{text}} placeholder")
 
-    def translate(text: str, prev_text: str, next_text: str) -> str:
-        retries = 2
-        while retries >= 0:
-            try:
-                client = OpenAI(api_key=api_key, base_url=base_url)
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": system_prompt,
-                        },
-                        {
-                            "role": "user",
-                            "content": input_prompt.replace("{{prev_text}}", prev_text)
-                            .replace("{{dest}}", dest)
-                            .replace("{{text}}", text)
-                            .replace("{{next_text}}", next_text),
-                        },
-                    ],
-                    temperature=tempterature,
-                    stream=False,
-                )
-                result = response.choices[0].message.content
+    if limiter is None:
+        limiter = RateLimiter(max_concurrency=pool_size)
+    client_pool = ClientPool(
+        lambda: AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=DefaultAsyncHttpxClient(
+                limits=pool_limits(pool_size), http2=HTTP2_AVAILABLE
+            ),
+            # Retries are handled by the rate limiter
+            max_retries=0,
+        ),
+        close=lambda client: client.close(),
+    )
 
-                if extra_type == "json":
-                    try:
-                        return json.loads(result)["translated"]
-                    except Exception as e:
-                        print(f"Having trouble extracting JSON: {e}")
-                        return result
-                elif extra_type == "markdown":
-                    try:
-                        return result[result.find("```") + 3:result.rfind("```")]
-                    except Exception as e:
-                        print(f"Having trouble extracting markdown: {e}")
-                        return result
-                return result
-            except Exception as e:
-                if retries > 0:
-                    print(f"Error occurred: {e}. Retrying... ({retries} attempts left)")
-                    retries -= 1
-                    continue
-                else:
-                    print(f"Error after all retries: {e}")
-                    return text
+    async def translate(
+        text: str, prev_text: str, next_text: str, system: str = None
+    ) -> str:
+        messages = [
+            {
+                "role": "system",
+                "content": system or system_prompt,
+            },
+            {
+                "role": "user",
+                "content": input_prompt.replace("{{prev_text}}", prev_text)
+                .replace("{{dest}}", dest)
+                .replace("{{text}}", text)
+                .replace("{{next_text}}", next_text),
+            },
+        ]
+        # Prompt plus a translation of about the same size as the text
+        tokens = count_tokens(messages[0]["content"] + messages[1]["content"])
+        tokens += count_tokens(text)
 
+        async def request():
+            start = time.monotonic()
+            completion = await chat_completion(
+                client_pool.get(),
+                extra_type,
+                stream=stream,
+                listener=translate.stream_listener,
+                model=model,
+                messages=messages,
+                temperature=tempterature,
+                response_format=response_format,
+            )
+            usage.record(time.monotonic() - start, completion.output_tokens)
+            return completion
+
+        try:
+            completion = await limiter.call(request, tokens=tokens)
+        except Exception as e:
+            print(f"Error after all retries: {e}")
+            return text
+        total_tokens = completion.total_tokens
+        if total_tokens is None:
+            # Streamed responses report no usage, estimate it from the output
+            total_tokens = tokens - count_tokens(text) + completion.output_tokens
+        limiter.consume(total_tokens - tokens)
+        return completion.result
+
+    translate.cache_namespace = json.dumps(
+        ["openai", base_url, model, src, dest, system_prompt, input_prompt, extra_type],
+        ensure_ascii=False,
+    )
+    if batch_size > 1:
+        translate.translate_batch = llm_translate_batch(
+            translate, system_prompt, extra_type
+        )
+        translate.batch_size = batch_size
+        translate.batch_chars = batch_chars
+    translate.translate_strict = llm_translate_strict(translate, system_prompt)
+    translate.translate_with_reference = llm_translate_reference(
+        translate, system_prompt
+    )
+    translate.chunk_tokens = 1024
+    translate.limiter = limiter
+    translate.usage = usage
+    translate.stream_listener = None
+    translate.client_pool = client_pool
+    translate.aclose = client_pool.aclose
     return translate
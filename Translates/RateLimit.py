@@ -0,0 +1,227 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+import httpx
+import openai
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRY_STATUS = {408, 409, 429}
+
+
+def status_code(error: Exception):
+    """Return the HTTP status code carried by an openai/httpx error, if any"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def retry_after(error: Exception):
+    """Return the delay in seconds requested by a Retry-After header, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    status = status_code(error)
+    if status is not None:
+        return status in RETRY_STATUS or status >= 500
+    return isinstance(
+        error, (httpx.TransportError, openai.APIConnectionError, asyncio.TimeoutError)
+    )
+
+
+class RateLimiter:
+    """Rate limiter shared by every request of a translator
+
+    Combines token buckets for requests per minute and tokens per minute with an
+    AIMD concurrency window: the window starts small and grows with each
+    success, is halved on every 429, and never exceeds ``max_concurrency``
+    (the THREADS setting). Failed requests are retried with jittered
+    exponential backoff, honouring ``Retry-After``; a 429 pauses all requests
+    until the requested time has passed.
+
+    The limiter only waits with ``asyncio.sleep``, so it can be shared across
+    event loops and threads.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        """
+        Args:
+            max_concurrency: Ceiling of concurrent requests
+            requests_per_minute: Requests per minute allowed by the provider, 0 for no limit
+            tokens_per_minute: Tokens per minute allowed by the provider, 0 for no limit
+            max_retries: How many times a failed request is retried
+            base_delay: Backoff delay of the first retry, in seconds
+            max_delay: Maximum backoff delay, in seconds
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._window = float(min(self.max_concurrency, 4))
+        self._slow_start = True
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+
+        self.retries = 0
+        self.throttled = 0
+
+    @property
+    def window(self) -> int:
+        return max(1, int(self._window))
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        if self.requests_per_minute:
+            self._request_allowance = min(
+                self.requests_per_minute,
+                self._request_allowance + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._token_allowance = min(
+                self.tokens_per_minute,
+                self._token_allowance + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Take a slot if possible, otherwise return how long to wait"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._in_flight >= self.window:
+                return 0.05
+            wait = 0.0
+            if self.requests_per_minute and self._request_allowance < 1:
+                wait = (1 - self._request_allowance) * 60 / self.requests_per_minute
+            # A single request larger than the budget only waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+            if self.tokens_per_minute and self._token_allowance < tokens:
+                wait = max(
+                    wait,
+                    (tokens - self._token_allowance) * 60 / self.tokens_per_minute,
+                )
+            if wait > 0:
+                return wait
+            self._in_flight += 1
+            if self.requests_per_minute:
+                self._request_allowance -= 1
+            if self.tokens_per_minute:
+                self._token_allowance -= tokens
+            return 0.0
+
+    async def acquire(self, tokens: int = 0) -> None:
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, success: bool) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            if success:
+                # Slow start doubles the window every round, then grow by one per round
+                step = 1.0 if self._slow_start else 1.0 / self._window
+                self._window = min(self.max_concurrency, self._window + step)
+
+    def consume(self, tokens: int) -> None:
+        """Correct the token bucket once the real usage of a request is known"""
+        if not self.tokens_per_minute:
+            return
+        with self._lock:
+            self._token_allowance = min(
+                self.tokens_per_minute, self._token_allowance - tokens
+            )
+
+    def _throttle(self, delay: float) -> None:
+        with self._lock:
+            self.throttled += 1
+            self._slow_start = False
+            self._window = max(1.0, self._window / 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def call(self, request: callable, tokens: int = 0):
+        """Await request() within the limits, retrying it when it fails
+
+        Args:
+            request: Function returning a new awaitable for each attempt
+            tokens: Estimated tokens used by the request
+
+        Returns:
+            The result of the successful attempt; the last error is raised once
+            the retries are exhausted or the error is not retryable
+        """
+        attempt = 0
+        while True:
+            await self.acquire(tokens)
+            try:
+                result = await request()
+            except Exception as e:
+                self.release(success=False)
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                if status_code(e) == 429:
+                    self._throttle(delay)
+                attempt += 1
+                self.retries += 1
+                print(
+                    f"Error occurred: {e}. Retrying in {delay:.1f}s... "
+                    f"(Attempt {attempt} of {self.max_retries})"
+                )
+                await asyncio.sleep(delay)
+                continue
+            self.release(success=True)
+            return result
+
+    def summary(self) -> str:
+        return (
+            f"Rate limiter: {self.retries} retries, {self.throttled} rate limited, "
+            f"concurrency window {self.window}/{self.max_concurrency}"
+        )
@@ -18,22 +18,31 @@ from PySide6.QtWidgets import (
     QProgressBar,
     QDialog,
     QPlainTextEdit,
+    QCheckBox,
 )
 from PySide6.QtCore import Qt, QThread, Signal
 from PySide6.QtGui import QDragEnterEvent, QDropEvent
 from PySide6.QtCore import QFile, QTextStream
 import breeze_pyside6
 import builtins
-from Main import get_translator, Process_MD
+from Main import (
+    get_translator,
+    create_cache,
+    create_image_fetcher,
+    create_job_manager,
+    create_memory,
+)
 from tqdm import tqdm
 import Split_MD
 import asyncio
-from pdfdeal.Doc2X.ConvertV2 import upload_pdf, uid_status
+from MD_Translate import render_docx, translate_markdown_file, translate_pdf_pages
 from PySide6.QtWidgets import QMessageBox
-from pdfdeal.file_tools import md_replace_imgs
+from image_fetch import image_folder
+from pdf_convert import ConversionStopped
 from file_tool import fix_image_size
 import traceback
 import signal
+import multiprocessing
 
 # 常量
 CONFIG_DIR = os.path.expanduser("~/.config/Doc2X")
@@ -42,6 +51,10 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, ".env")
 
 # 设置环境变量
 def set_translator_env(translator_type, config):
+    os.environ["THREADS"] = config.get("THREADS", "10")
+    os.environ["REQUESTS_PER_MINUTE"] = config.get("REQUESTS_PER_MINUTE", "0")
+    os.environ["TOKENS_PER_MINUTE"] = config.get("TOKENS_PER_MINUTE", "0")
+    os.environ["MAX_RETRIES"] = config.get("MAX_RETRIES", "5")
     if translator_type == "deepl":
         os.environ["deepl_apikey"] = config.get("deepl_apikey", "")
         os.environ["deepl_dest"] = config.get("deepl_dest", "")
@@ -59,8 +72,12 @@ def set_translator_env(translator_type, config):
         os.environ["system_prompt"] = config.get("system_prompt", "")
         os.environ["input"] = config.get("input", "")
         os.environ["extra_type"] = config.get("extra_type", "markdown")
+        os.environ["prompt_profile"] = config.get("prompt_profile", "quality")
+        os.environ["llm_stream"] = config.get("llm_stream", "false")
         os.environ["llm_src"] = config.get("llm_src", "English")
         os.environ["llm_dest"] = config.get("llm_dest", "中文")
+        os.environ["llm_batch_size"] = config.get("llm_batch_size", "1")
+        os.environ["llm_batch_chars"] = config.get("llm_batch_chars", "4000")
     elif translator_type == "openai":
         os.environ["openai_apikey"] = config.get("openai_apikey", "")
         os.environ["openai_baseurl"] = config.get("openai_baseurl", "")
@@ -70,8 +87,12 @@ def set_translator_env(translator_type, config):
         os.environ["system_prompt"] = config.get("system_prompt", "")
         os.environ["input"] = config.get("input", "")
         os.environ["extra_type"] = config.get("extra_type", "markdown")
+        os.environ["prompt_profile"] = config.get("prompt_profile", "quality")
+        os.environ["llm_stream"] = config.get("llm_stream", "false")
         os.environ["llm_src"] = config.get("llm_src", "English")
         os.environ["llm_dest"] = config.get("llm_dest", "中文")
+        os.environ["llm_batch_size"] = config.get("llm_batch_size", "1")
+        os.environ["llm_batch_chars"] = config.get("llm_batch_chars", "4000")
     elif translator_type == "ollama":
         os.environ["ollama_baseurl"] = config.get("ollama_baseurl", "")
         os.environ["ollama_model"] = config.get("ollama_model", "")
@@ -80,8 +101,12 @@ def set_translator_env(translator_type, config):
         os.environ["system_prompt"] = config.get("system_prompt", "")
         os.environ["input"] = config.get("input", "")
         os.environ["extra_type"] = config.get("extra_type", "markdown")
+        os.environ["prompt_profile"] = config.get("prompt_profile", "quality")
+        os.environ["llm_stream"] = config.get("llm_stream", "false")
         os.environ["llm_src"] = config.get("llm_src", "English")
         os.environ["llm_dest"] = config.get("llm_dest", "中文")
+        os.environ["llm_batch_size"] = config.get("llm_batch_size", "1")
+        os.environ["llm_batch_chars"] = config.get("llm_batch_chars", "4000")
 
 
 class LLMSettingsDialog(QDialog):
@@ -148,6 +173,22 @@ class LLMSettingsDialog(QDialog):
         extra_layout.addWidget(self.extra_combo)
         layout.addLayout(extra_layout)
 
+        # 提示词档位
+        profile_layout = QHBoxLayout()
+        profile_layout.addWidget(QLabel("提示词档位(未自定义输入提示时生效):"))
+        self.profile_combo = QComboBox()
+        self.profile_combo.addItems(["fast", "balanced", "quality"])
+        self.profile_combo.setCurrentText(self.config.get("prompt_profile", "quality"))
+        profile_layout.addWidget(self.profile_combo)
+        layout.addLayout(profile_layout)
+
+        # 流式接收
+        self.stream_checkbox = QCheckBox("流式接收响应(译文接收完毕即结束请求)")
+        self.stream_checkbox.setChecked(
+            self.config.get("llm_stream", "false") == "true"
+        )
+        layout.addWidget(self.stream_checkbox)
+
         # 源语言
         src_layout = QHBoxLayout()
         src_layout.addWidget(QLabel("源语言:"))
@@ -164,6 +205,18 @@ class LLMSettingsDialog(QDialog):
         dest_layout.addWidget(self.dest_input)
         layout.addLayout(dest_layout)
 
+        # 批量翻译
+        batch_layout = QHBoxLayout()
+        batch_layout.addWidget(QLabel("每次请求合并段落数(1 为不合并):"))
+        self.batch_size_input = QLineEdit()
+        self.batch_size_input.setText(self.config.get("llm_batch_size", "1"))
+        batch_layout.addWidget(self.batch_size_input)
+        batch_layout.addWidget(QLabel("最多字符数:"))
+        self.batch_chars_input = QLineEdit()
+        self.batch_chars_input.setText(self.config.get("llm_batch_chars", "4000"))
+        batch_layout.addWidget(self.batch_chars_input)
+        layout.addLayout(batch_layout)
+
         # 按钮
         button_layout = QHBoxLayout()
         save_btn = QPushButton("保存")
@@ -184,8 +237,12 @@ class LLMSettingsDialog(QDialog):
             "system_prompt": self.system_input.toPlainText(),
             "input": self.input_prompt.toPlainText(),
             "extra_type": self.extra_combo.currentText(),
+            "prompt_profile": self.profile_combo.currentText(),
+            "llm_stream": "true" if self.stream_checkbox.isChecked() else "false",
             "llm_src": self.src_input.text(),
             "llm_dest": self.dest_input.text(),
+            "llm_batch_size": self.batch_size_input.text(),
+            "llm_batch_chars": self.batch_chars_input.text(),
         }
 
 
@@ -194,15 +251,18 @@ class TranslateThread(QThread):
     finished = Signal()
     error = Signal(str)
     progress = Signal(int, int)  # 当前，总计
+    received = Signal(int)  # 流式接收的字符数
 
-    def __init__(self, file_path, config, translator_type):
+    def __init__(self, file_path, config, translator_type, resume=False):
         super().__init__()
         self.file_path = file_path
         self.config = config
         self.translator_type = translator_type
+        self.resume = resume
         self.is_running = True
 
     def run(self):
+        fetcher = None
         try:
             # 设置环境变量
             set_translator_env(self.translator_type, self.config)
@@ -241,27 +301,93 @@ class TranslateThread(QThread):
 
             # 根据配置获取翻译器
             translator = get_translator(self.translator_type)
-            if self.file_path.endswith(".pdf"):
+            received_chars = 0
 
-                async def process_pdf(file_path, apikey):
+            def stream_listener(chars):
+                nonlocal received_chars
+                received_chars += chars
+                if self.is_running:
+                    self.received.emit(received_chars)
+
+            translator.stream_listener = stream_listener
+            cache = create_cache(
+                self.config.get("TRANSLATE_CACHE", "true").lower() == "true"
+            )
+            memory = create_memory(
+                self.config.get("TRANSLATION_MEMORY", "true").lower() == "true"
+            )
+            fetcher = create_image_fetcher()
+            fix_processes = (
+                self.config.get("IMAGE_FIX_PROCESSES", "false").lower() == "true"
+            )
+            if (
+                self.file_path.endswith(".pdf")
+                and self.config.get("PAGE_STREAMING", "true").lower() == "true"
+            ):
+                # 边转换边翻译：Doc2X 每转换完一页即开始翻译该页
+                try:
+                    jobs = create_job_manager(
+                        self.config.get("DOC2X_APIKEY", "sk-xxx"), fetcher=fetcher
+                    )
+                    print("正在上传 PDF...")
+                    job = jobs.upload(self.file_path)
                     if not self.is_running:
                         return
-                    print("正在上传 PDF...")
-                    uid = await upload_pdf(apikey=apikey, pdffile=file_path)
-                    print("正在处理 PDF...")
-                    while True and self.is_running:
-                        process, status, texts, locations = await uid_status(
-                            apikey=apikey, uid=uid
-                        )
-                        self.progress.emit(process, 100)
-                        if process == 100:
-                            return texts
-                        await asyncio.sleep(3)
-
-                apikey = self.config.get("DOC2X_APIKEY", "sk-xxx")
-                md_texts = asyncio.run(process_pdf(self.file_path, apikey))
+                    print("翻译中（PDF 转换完成的页面将立即开始翻译）...")
+                    output_md_path = translate_pdf_pages(
+                        self.file_path,
+                        fetcher.prefetch_pages(
+                            jobs.pages(job, is_running=lambda: self.is_running)
+                        ),
+                        translator,
+                        thread=int(self.config.get("THREADS", 10)),
+                        cache=cache,
+                        resume=self.resume,
+                        memory=memory,
+                    )
+                    if not self.is_running:
+                        return
+                    print("等待图片下载（如果有）...")
+                    fetcher.replace_images(output_md_path)
+                    print(fetcher.summary())
+                    if jobs.cache is not None:
+                        print(jobs.cache.summary())
+                    print("开始修复图片大小以解决 pandoc 中图片尺寸问题:")
+                    fix_image_size(
+                        image_folder(output_md_path), use_processes=fix_processes
+                    )
+                    render_docx(output_md_path)
+                except ConversionStopped:
+                    # 已停止：保留翻译日志，可继续翻译
+                    return
+                except Exception as e:
+                    print(f"翻译失败: {e}")
+                    print(traceback.format_exc())
+                finally:
+                    # 恢复原始打印
+                    builtins.print = original_print
+                if self.is_running:
+                    self.finished.emit()
+                return
+            if self.file_path.endswith(".pdf"):
+
+                jobs = create_job_manager(
+                    self.config.get("DOC2X_APIKEY", "sk-xxx"),
+                    on_progress=lambda job: self.progress.emit(job.progress, 100),
+                    fetcher=fetcher,
+                )
+                print("正在上传 PDF...")
+                job = jobs.upload(self.file_path)
+                if not self.is_running:
+                    return
+                print("正在处理 PDF...")
+                md_texts = asyncio.run(
+                    jobs.wait(job, is_running=lambda: self.is_running)
+                )
                 if not self.is_running:
                     return
+                if jobs.cache is not None:
+                    print(jobs.cache.summary())
                 md_text = "\n".join(md_texts)
                 # 预处理 PDF 转换的 markdown 文本
 
@@ -273,28 +399,35 @@ class TranslateThread(QThread):
                 with open(output_md_path, "w", encoding="utf-8") as f:
                     f.write(md_text)
                 self.file_path = output_md_path
-            print("开始下载图片（如果有）...")
             if not self.is_running:
                 return
-            md_replace_imgs(mdfile=self.file_path, replace="local", threads=10)
-            print("开始修复图片大小以解决 pandoc 中图片尺寸问题:")
-            if not self.is_running:
-                return
-            img_dir = os.path.dirname(self.file_path)
-            img_folder = (
-                ".".join(os.path.basename(self.file_path).split(".")[:-1]) + "_img"
-            )
-            fix_image_size(os.path.join(img_dir, img_folder))
+            # 图片在翻译期间于后台下载
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                fetcher.prefetch(f.read())
             print("翻译中...")
-            if not self.is_running:
-                return
             self.progress.emit(0, 100)
             try:
-                Process_MD(
-                    md_file=self.file_path,
-                    translate=translator,
+                output_md_path = translate_markdown_file(
+                    self.file_path,
+                    translator,
                     thread=int(self.config.get("THREADS", 10)),
+                    cache=cache,
+                    resume=self.resume,
+                    memory=memory,
+                )
+                if not self.is_running:
+                    return
+                print("等待图片下载（如果有）...")
+                fetcher.replace_images(self.file_path)
+                fetcher.replace_images(
+                    output_md_path, folder=image_folder(self.file_path)
                 )
+                print(fetcher.summary())
+                print("开始修复图片大小以解决 pandoc 中图片尺寸问题:")
+                fix_image_size(
+                    image_folder(self.file_path), use_processes=fix_processes
+                )
+                render_docx(output_md_path)
             except Exception as e:
                 print(f"翻译失败: {e}")
                 print(traceback.format_exc())
@@ -307,6 +440,9 @@ class TranslateThread(QThread):
         except Exception as e:
             if self.is_running:
                 self.error.emit(str(e))
+        finally:
+            if fetcher is not None:
+                fetcher.close()
 
     def stop(self):
         self.is_running = False
@@ -402,7 +538,7 @@ class MainWindow(QMainWindow):
         thread_layout = QHBoxLayout()
         thread_layout.addWidget(QLabel("线程数:"))
         self.thread_spin = QSpinBox()
-        self.thread_spin.setRange(1, 100)
+        self.thread_spin.setRange(1, 500)
         self.thread_spin.setValue(int(self.config.get("THREADS", 10)))
         thread_layout.addWidget(self.thread_spin)
         layout.addLayout(thread_layout)
@@ -412,6 +548,10 @@ class MainWindow(QMainWindow):
         self.test_btn.clicked.connect(self.test_translator)
         layout.addWidget(self.test_btn)
 
+        # 继续上次中断的翻译
+        self.resume_checkbox = QCheckBox("继续上次未完成的翻译")
+        layout.addWidget(self.resume_checkbox)
+
         # 开始按钮
         self.start_btn = QPushButton("开始翻译")
         self.start_btn.clicked.connect(self.start_translation)
@@ -423,6 +563,11 @@ class MainWindow(QMainWindow):
         self.progress_bar.hide()
         layout.addWidget(self.progress_bar)
 
+        # 流式接收进度
+        self.received_label = QLabel()
+        self.received_label.hide()
+        layout.addWidget(self.received_label)
+
         # 输出文本
         self.output_text = QTextEdit()
         self.output_text.setReadOnly(True)
@@ -542,7 +687,7 @@ class MainWindow(QMainWindow):
             def run(self):
                 try:
                     translator = get_translator(self.translator_type)
-                    test = translator("Hello, how are you?", "", "")
+                    test = Split_MD.run_translate(translator, "Hello, how are you?")
                     if test == "Hello, how are you?":
                         self.failure.emit("翻译器测试失败，请检查设置。")
                     else:
@@ -588,7 +733,10 @@ class MainWindow(QMainWindow):
 
         # 创建并启动翻译线程
         self.translate_thread = TranslateThread(
-            self.file_drop.file_path, self.config, self.translator_combo.currentText()
+            self.file_drop.file_path,
+            self.config,
+            self.translator_combo.currentText(),
+            resume=self.resume_checkbox.isChecked(),
         )
         self.translate_thread.output.connect(lambda x: self.output_text.append(x))
         self.translate_thread.finished.connect(self.on_translation_finished)
@@ -596,15 +744,21 @@ class MainWindow(QMainWindow):
             lambda x: self.output_text.append(f"错误: {x}")
         )
         self.translate_thread.progress.connect(self.update_progress)
+        self.translate_thread.received.connect(self.update_received)
         self.translate_thread.start()
 
     def update_progress(self, current, total):
         self.progress_bar.setMaximum(total)
         self.progress_bar.setValue(current)
 
+    def update_received(self, chars):
+        self.received_label.setText(f"已流式接收 {chars} 个字符")
+        self.received_label.show()
+
     def on_translation_finished(self):
         self.open_folder_btn.show()
         self.progress_bar.hide()
+        self.received_label.hide()
         # 翻译后重新启用按钮和输入框
         self.set_buttons_and_inputs_enabled(True)
 
@@ -614,6 +768,7 @@ class MainWindow(QMainWindow):
         self.api_input.setEnabled(enabled)
         self.translator_combo.setEnabled(enabled)
         self.thread_spin.setEnabled(enabled)
+        self.resume_checkbox.setEnabled(enabled)
         self.file_drop.setEnabled(enabled)
         self.llm_settings_btn.setEnabled(enabled)
 
@@ -624,6 +779,8 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == "__main__":
+    # 打包后的程序中，IMAGE_FIX_PROCESSES 启动的子进程需要由此进入
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
 
     # 根据系统主题设置样式表
@@ -0,0 +1,214 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+DOCUMENT_EXTENSIONS = (".md", ".pdf")
+
+
+def find_documents(path: str, exclude: str = None) -> List[str]:
+    """Collect the markdown and PDF files to translate
+
+    Args:
+        path: A file, a directory (searched recursively) or a glob pattern
+        exclude: Folder whose files are skipped, e.g. the output folder
+
+    Returns:
+        List[str]: The documents, sorted by path
+    """
+    if os.path.isfile(path):
+        return [path]
+    if os.path.isdir(path):
+        candidates = glob.glob(os.path.join(path, "**", "*"), recursive=True)
+    else:
+        candidates = glob.glob(path, recursive=True)
+    return sorted(
+        file
+        for file in candidates
+        if os.path.isfile(file) and file.lower().endswith(DOCUMENT_EXTENSIONS)
+        # Skip the outputs of earlier runs found in the same tree
+        and "_translated_" not in os.path.basename(file)
+        and not (exclude and is_within(file, exclude))
+    )
+
+
+def is_within(path: str, folder: str) -> bool:
+    folder = os.path.abspath(folder)
+    return os.path.commonpath([os.path.abspath(path), folder]) == folder
+
+
+def output_dirs(documents: List[str], output_path: str) -> dict:
+    """Output folder of each document, mirroring its folder below their common root
+
+    Documents with the same name in different folders thus do not overwrite
+    each other's outputs.
+    """
+    if not documents:
+        return {}
+    folders = [os.path.dirname(os.path.abspath(document)) for document in documents]
+    root = os.path.commonpath(folders)
+    return {
+        document: os.path.normpath(
+            os.path.join(output_path, os.path.relpath(folder, root))
+        )
+        for document, folder in zip(documents, folders)
+    }
+
+
+class Manifest:
+    """JSON manifest of a batch run, with the status and outputs of every document
+
+    The manifest is rewritten after every change, so it always describes the
+    state of the run, and documents already done can be skipped on a rerun.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.documents = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.documents = json.load(f).get("documents", {})
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"Ignoring unreadable manifest {path}: {e}")
+
+    def is_done(self, document: str) -> bool:
+        return self.documents.get(document, {}).get("status") == "done"
+
+    def update(self, document: str, **fields) -> None:
+        """Update the entry of a document and write the manifest to disk"""
+        with self._lock:
+            self.documents.setdefault(document, {}).update(fields)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"documents": self.documents}, f, ensure_ascii=False, indent=2
+                )
+            os.replace(temp_path, self.path)
+
+    def summary(self) -> str:
+        statuses = [entry.get("status") for entry in self.documents.values()]
+        return (
+            f"Batch: {statuses.count('done')} done, {statuses.count('failed')} failed, "
+            f"manifest saved to {self.path}"
+        )
+
+
+@dataclass
+class Document:
+    """A document moving through the pipeline"""
+
+    source: str
+    output_path: str
+    # Markdown file to translate, set by the conversion of a PDF
+    markdown: str = None
+    # Doc2XJob converting a PDF
+    job: object = None
+    # Paths of the outputs, recorded in the manifest
+    outputs: dict = field(default_factory=dict)
+
+
+@dataclass
+class Stage:
+    """A pipeline stage, running func(document) on `workers` threads"""
+
+    name: str
+    func: callable
+    workers: int = 1
+
+
+STOP = object()
+
+
+def run_pipeline(
+    documents: List[Document],
+    stages: List[Stage],
+    manifest: Manifest,
+    queue_size: int = 2,
+    skip_done: bool = False,
+) -> None:
+    """Run documents through consecutive stages, each with its own workers
+
+    Stages are connected by queues holding at most `queue_size` documents, so
+    a stage never runs far ahead of the next one: while one document is
+    translated, the next one is being converted and the previous one rendered.
+    All translating workers share the same translator, whose rate limiter
+    bounds the requests in flight across documents.
+
+    A document failing in a stage is recorded as failed and leaves the
+    pipeline, the other documents carry on.
+
+    Args:
+        documents: The documents to process
+        stages: The stages, in order
+        manifest: The manifest of the run, updated as documents move on
+        queue_size: Maximum number of documents waiting before each stage
+        skip_done: Skip the documents the manifest records as done
+    """
+    if skip_done:
+        skipped = [d for d in documents if manifest.is_done(d.source)]
+        if skipped:
+            print(f"Skipping {len(skipped)} documents already done")
+        documents = [d for d in documents if not manifest.is_done(d.source)]
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    workers = [max(1, stage.workers) for stage in stages]
+    running = list(workers)
+    lock = threading.Lock()
+    started = {}
+
+    def work(index: int) -> None:
+        stage = stages[index]
+        while True:
+            document = queues[index].get()
+            if document is STOP:
+                break
+            manifest.update(document.source, status=stage.name, error=None)
+            try:
+                stage.func(document)
+            except Exception as e:
+                print(f"Error processing {document.source} ({stage.name}): {e}")
+                manifest.update(
+                    document.source,
+                    status="failed",
+                    error=f"{stage.name}: {e}",
+                    seconds=round(time.monotonic() - started[document.source], 1),
+                )
+                continue
+            if index + 1 < len(stages):
+                queues[index + 1].put(document)
+            else:
+                manifest.update(
+                    document.source,
+                    status="done",
+                    seconds=round(time.monotonic() - started[document.source], 1),
+                    **document.outputs,
+                )
+        # The last worker of a stage to stop stops the next stage
+        with lock:
+            running[index] -= 1
+            last = running[index] == 0
+        if last and index + 1 < len(stages):
+            for _ in range(workers[index + 1]):
+                queues[index + 1].put(STOP)
+
+    threads = [
+        threading.Thread(target=work, args=(index,), daemon=True)
+        for index in range(len(stages))
+        for _ in range(workers[index])
+    ]
+    for thread in threads:
+        thread.start()
+    for document in documents:
+        started[document.source] = time.monotonic()
+        queues[0].put(document)
+    for _ in range(workers[0]):
+        queues[0].put(STOP)
+    for thread in threads:
+        thread.join()
+    print(manifest.summary())
@@ -0,0 +1,106 @@
+"""Micro-benchmark: neighbour context lookup in concurrent_translate
+
+Compares the previous per-block linear scan (``A.index`` plus slicing) against
+``Split_MD.build_context_index`` for documents of 100 to 50,000 blocks.
+
+Run from the repository root:
+
+    python benchmarks/context_index.py
+    python benchmarks/context_index.py --sizes 100 1000 10000 --legacy-max 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Split_MD import Block, build_context_index, split_markdown, split_text_blocks
+
+
+def make_blocks(n: int) -> List[Block]:
+    """Build a synthetic document that splits into roughly n blocks"""
+    paragraph = "The quick brown fox jumps over the lazy dog $x^2$. " * 14
+    parts = []
+    for i in range(n // 3 + 1):
+        parts.append(f"# Section {i}")
+        parts.append(paragraph)
+        parts.append("$$\nE = mc^2\n$$")
+    blocks = split_text_blocks(split_markdown("\n\n".join(parts)))
+    return blocks[:n]
+
+
+def legacy_context(A: List[Block]):
+    """The lookup previously done inside process_block, once per text block"""
+    result = []
+    for block in A:
+        if block.type != "text":
+            result.append(("", ""))
+            continue
+        prev_block = None
+        next_block = None
+        if block.sub_position > 1:
+            for b in reversed(A[: A.index(block)]):
+                if (
+                    b.position == block.position
+                    and b.sub_position == block.sub_position - 1
+                ):
+                    prev_block = b.content
+                    break
+        else:
+            for b in reversed(A[: A.index(block)]):
+                if b.position == block.position - 1:
+                    prev_block = b.content
+                    break
+        for b in A[A.index(block) + 1 :]:
+            if (
+                b.position == block.position
+                and b.sub_position == block.sub_position + 1
+            ):
+                next_block = b.content
+                break
+            elif b.position == block.position + 1:
+                next_block = b.content
+                break
+        result.append((prev_block or "", next_block or ""))
+    return result
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000, 50000]
+    )
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=5000,
+        help="Largest size to run the quadratic lookup on (it gets slow quickly)",
+    )
+    args = parser.parse_args()
+
+    print(f"{'blocks':>8} {'legacy (s)':>12} {'index (s)':>12} {'speedup':>10}")
+    for size in args.sizes:
+        blocks = make_blocks(size)
+        index_time, index_result = timed(build_context_index, blocks)
+        if size <= args.legacy_max:
+            legacy_time, legacy_result = timed(legacy_context, blocks)
+            assert legacy_result == index_result, "context index differs from legacy"
+            print(
+                f"{len(blocks):>8} {legacy_time:>12.4f} {index_time:>12.4f}"
+                f" {legacy_time / index_time:>9.1f}x"
+            )
+        else:
+            print(f"{len(blocks):>8} {'skipped':>12} {index_time:>12.4f} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Benchmark: markdown preprocessing and block splitting on large documents
+
+Compares three ways of normalising a Doc2X markdown dump before splitting it
+into blocks:
+
+- legacy: the previous chain of eight ``re.sub`` passes and block scan
+- single-pass: one combined scanner doing every rewrite in a single traversal,
+  dispatching each match to a Python callback
+- current: ``Split_MD.preprocess_markdown`` and ``Split_MD.split_markdown``
+
+All three must produce identical blocks.
+
+Run from the repository root:
+
+    python benchmarks/preprocess.py
+    python benchmarks/preprocess.py --size-mb 50 --repeat 5
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Split_MD import Block, preprocess_markdown, split_markdown
+
+SAMPLE = r"""# Section
+
+Some text with inline \(x^2 + y\) math and $a_i$, and a [link](https://example.com) to pad the paragraph out a little.
+<!-- Media -->
+<img src="images/figure.png"/>
+<!-- Footnote -->
+\[
+E = mc^2 \tag{1}
+\]\[
+F = ma
+\]
+$$
+a
+$$$$
+b
+$$
+\begin{center}
+\adjustbox{max width=\textwidth}{
+\begin{tabular}{cc} a & \(b\) \tag{2} \\
+\end{tabular}
+}
+\end{center}
+<table><tr><td>1</td></tr></table>
+![figure](images/figure.png)
+"""
+
+
+def legacy_preprocess(input_markdown: str) -> str:
+    pattern1 = re.compile(
+        r"\\begin{center}\s*\\adjustbox{max width=\\textwidth}{\s*(.*?)\s*\\end{tabular}\s*}\s*\\end{center}",
+        re.DOTALL,
+    )
+    replacement1 = r"\\begin{center}\n\1\n\\end{tabular}\n\\end{center}"
+    input_markdown = re.sub(pattern1, replacement1, input_markdown)
+    pattern2 = re.compile(r"\\tag\{(.*?)\}")
+    replacement2 = r"\\qquad \\text{(\1)}"
+    input_markdown = re.sub(pattern2, replacement2, input_markdown)
+    input_markdown = re.sub(r"<!-- Media -->\n?", "", input_markdown)
+    input_markdown = re.sub(r"<!-- Footnote -->\n?", "", input_markdown)
+    input_markdown = re.sub(r"\\[()]", "$", input_markdown)
+    input_markdown = re.sub(r"\\[\[\]]", "$$", input_markdown)
+    input_markdown = re.sub(r"\$\$\$\$", "$$\n$$", input_markdown)
+    return input_markdown
+
+
+def legacy_split(content: str):
+    A = []
+    pattern = re.compile(
+        r"(?P<title>^#{1,6} .+?$)|"
+        r"(?P<table><table[\s\S]*?<\/table>)|"
+        r"(?P<block_formula>\$\$[\s\S]+?\$\$)|"
+        r'(?P<img><img src="[^"]+"\/?>)|'
+        r"(?P<link_img>!\[.*?\]\([^\)]+\))|"
+        r"(?P<link>\[[^\]]+\]\([^\)]+\))",
+        re.MULTILINE,
+    )
+    names = {"img": "image", "link_img": "link_image"}
+    pos = 0
+    for match in pattern.finditer(content):
+        start, end = match.span()
+        if start > pos:
+            text = content[pos:start].strip()
+            if text:
+                A.append(Block(position=len(A) + 1, type="text", content=text))
+        for name in ["title", "table", "block_formula", "img", "link_img", "link"]:
+            if match.group(name):
+                A.append(
+                    Block(
+                        position=len(A) + 1,
+                        type=names.get(name, name),
+                        content=match.group(name),
+                    )
+                )
+                break
+        pos = end
+    if pos < len(content):
+        text = content[pos:].strip()
+        if text:
+            A.append(Block(position=len(A) + 1, type="text", content=text))
+    return A
+
+
+MATH = r"(?:\$|\\[()\[\]])"
+SINGLE_PASS_PATTERN = re.compile(
+    r"(?=[\\<$])(?:"
+    r"\\begin{center}\s*\\adjustbox{max width=\\textwidth}{\s*(?P<adjustbox>(?s:.*?))\s*\\end{tabular}\s*}\s*\\end{center}|"
+    r"\\tag\{(?P<tag>.*?)\}|"
+    r"(?P<comment><!-- (?:Media|Footnote) -->\n?)|"
+    rf"(?P<math>{MATH}*(?:\\[()\[\]]|\$\$\$\$){MATH}*)"
+    r")"
+)
+DELIMITERS = {"\\(": "$", "\\)": "$", "\\[": "$$", "\\]": "$$"}
+DELIMITER_PATTERN = re.compile(r"\\[()\[\]]")
+
+
+def single_pass_rewrite(match: re.Match) -> str:
+    kind = match.lastgroup
+    if kind == "math":
+        text = match.group()
+        if text in DELIMITERS:
+            return DELIMITERS[text]
+        text = DELIMITER_PATTERN.sub(lambda m: DELIMITERS[m.group()], text)
+        return text.replace("$$$$", "$$\n$$")
+    if kind == "comment":
+        return ""
+    if kind == "tag":
+        inner = SINGLE_PASS_PATTERN.sub(single_pass_rewrite, match.group("tag"))
+        return "\\qquad \\text{(" + inner + ")}"
+    inner = SINGLE_PASS_PATTERN.sub(single_pass_rewrite, match.group("adjustbox"))
+    return "\\begin{center}\n" + inner + "\n\\end{tabular}\n\\end{center}"
+
+
+def single_pass_preprocess(content: str) -> str:
+    return SINGLE_PASS_PATTERN.sub(single_pass_rewrite, content)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    document = SAMPLE * int(args.size_mb * 1024 * 1024 / len(SAMPLE))
+    print(f"Document: {len(document) / 1024 / 1024:.1f} MB")
+    variants = [
+        ("legacy", legacy_preprocess, legacy_split),
+        ("single-pass", single_pass_preprocess, split_markdown),
+        ("current", preprocess_markdown, split_markdown),
+    ]
+    expected = None
+    print(f"{'variant':>12} {'preprocess (s)':>15} {'split (s)':>10} {'total (s)':>10}")
+    for name, preprocess, split in variants:
+        best = None
+        for _ in range(args.repeat):
+            preprocess_time, content = timed(preprocess, document)
+            split_time, blocks = timed(split, content)
+            if best is None or preprocess_time + split_time < sum(best):
+                best = (preprocess_time, split_time)
+        if expected is None:
+            expected = blocks
+        assert blocks == expected, f"{name} blocks differ from legacy"
+        print(f"{name:>12} {best[0]:>15.3f} {best[1]:>10.3f} {sum(best):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
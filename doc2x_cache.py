@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional
+from pdfdeal.FileTools.extract_img import get_imgcdnlink_list
+from image_fetch import ImageFetcher
+
+# Bump when the way conversions are requested or stored changes
+CACHE_VERSION = 1
+
+
+class ConversionCache:
+    """Disk cache of Doc2X conversions, keyed by the content of the PDF
+
+    Every entry is a folder named after the SHA-256 of the PDF bytes and the
+    conversion options. It holds the markdown of every page. The images they
+    reference are downloaded into the image cache when the entry is stored:
+    Doc2X image links expire, so cached pages point at the local copies
+    instead. A conversion whose images could not all be downloaded is not
+    stored, and an entry whose images are gone counts as a miss.
+    """
+
+    def __init__(
+        self, path: str = "./Output/doc2x_cache", fetcher: ImageFetcher = None
+    ):
+        """
+        Args:
+            path: Folder of the cache
+            fetcher: ImageFetcher storing the images, defaults to one in the folder
+        """
+        self.path = path
+        self.fetcher = (
+            fetcher
+            if fetcher is not None
+            else ImageFetcher(os.path.join(path, "images"))
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_key(pdf_file: str, options: dict = None) -> str:
+        """SHA-256 of the PDF bytes, the conversion options and the cache version"""
+        digest = hashlib.sha256()
+        with open(pdf_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        payload = json.dumps(
+            [CACHE_VERSION, options or {}], sort_keys=True, ensure_ascii=False
+        )
+        digest.update(payload.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """Return the cached pages, or None on a miss"""
+        pages_path = os.path.join(self.path, key, "pages.json")
+        try:
+            with open(pages_path, "r", encoding="utf-8") as f:
+                pages = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pages = None
+        if pages is not None and not all(
+            self.fetcher.is_cached(url) and os.path.exists(url)
+            for page in pages
+            for url in get_imgcdnlink_list(page)[1]
+        ):
+            pages = None
+        with self._lock:
+            if pages is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return pages
+
+    def put(self, key: str, pages: List[str]) -> List[str]:
+        """Store the pages of a conversion, with links to the cached images
+
+        Nothing is stored if an image could not be downloaded, its Doc2X link
+        would have expired by the time the entry is used.
+
+        Returns:
+            List[str]: The pages as stored, or as given if not stored
+        """
+        urls = {
+            url
+            for page in pages
+            for url in get_imgcdnlink_list(page)[1]
+            if url.startswith("http")
+        }
+        local = self.fetcher.fetch_all(urls)
+        if len(local) < len(urls):
+            print(
+                f"Not caching the Doc2X conversion, {len(urls) - len(local)} "
+                "images could not be downloaded"
+            )
+            return pages
+        folder = os.path.join(self.path, key)
+        os.makedirs(folder, exist_ok=True)
+        stored = []
+        for page in pages:
+            for url, image_path in local.items():
+                page = page.replace(url, image_path)
+            stored.append(page)
+        # Written last and atomically, so an entry is only visible once complete
+        temp_path = os.path.join(folder, "pages.json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False)
+        os.replace(temp_path, os.path.join(folder, "pages.json"))
+        return stored
+
+    def summary(self) -> str:
+        return f"Doc2X cache: {self.hits} hits, {self.misses} misses"
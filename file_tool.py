@@ -1,28 +1,65 @@
 from PIL import Image
 import os
+import json
 import concurrent.futures
+import multiprocessing
+from typing import Optional
 
+# Fingerprints of the images already fixed, kept in the image folder
+FINGERPRINT_FILE = ".fix_image_size.json"
 
-def process_image(file_path: str) -> None:
-    """Process a single image file by resaving it.
+
+def fingerprint(file_path: str) -> list:
+    """Size and modification time of a file, changed by any edit"""
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def needs_resave(img: Image.Image) -> bool:
+    """Whether pandoc would size an image from its resolution metadata
+
+    Pandoc sizes images from the DPI stored in their JFIF/EXIF/pHYs headers,
+    which is often wrong for converted figures. Resaving drops it. Only the
+    header is read, the pixels are not decoded.
+    """
+    return any(key in img.info for key in ("dpi", "exif", "resolution"))
+
+
+def process_image(file_path: str) -> Optional[list]:
+    """Process a single image file by resaving it if needed.
 
     Args:
         file_path (str): Path to the image file
+
+    Returns:
+        Optional[list]: Fingerprint of the processed file, None on error
     """
     try:
         # Open and resave image
         with Image.open(file_path) as img:
-            img.save(file_path, quality=95, optimize=True)
+            if needs_resave(img):
+                img.load()
+                img.save(file_path, quality=95, optimize=True)
+        return fingerprint(file_path)
     except Exception as e:
         print(f"Error processing {os.path.basename(file_path)}: {str(e)}")
+        return None
+
 
+def fix_image_size(
+    folder_path: str, max_workers: int = 10, use_processes: bool = False
+) -> None:
+    """Fix image size issue for pandoc by resaving images in the folder in parallel.
 
-def fix_image_size(folder_path: str, max_workers: int = 10) -> None:
-    """Fix image size issue for pandoc by resaving images in the folder using multiple threads.
+    Images left unchanged since the last run, according to the fingerprints
+    recorded in the folder, are skipped.
 
     Args:
         folder_path (str): Path to the folder containing images
-        max_workers (int, optional): Maximum number of worker threads. Defaults to 4.
+        max_workers (int, optional): Maximum number of workers. Defaults to 10.
+        use_processes (bool, optional): Use a process pool, so large sets of
+            images use every core instead of being throttled by the GIL.
+            Defaults to False.
     """
     # Check if folder exists
     if not os.path.exists(folder_path):
@@ -35,13 +72,38 @@ def fix_image_size(folder_path: str, max_workers: int = 10) -> None:
     # Common image extensions
     img_extensions = [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]
 
+    fingerprint_path = os.path.join(folder_path, FINGERPRINT_FILE)
+    try:
+        with open(fingerprint_path, "r", encoding="utf-8") as f:
+            fingerprints = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        fingerprints = {}
+
     # Get list of image files to process
     image_files = [
         os.path.join(folder_path, file)
         for file in files
         if any(file.lower().endswith(ext) for ext in img_extensions)
+        and fingerprints.get(file) != fingerprint(os.path.join(folder_path, file))
     ]
+    if not image_files:
+        return
+
+    # Process images in parallel using a thread or process pool
+    if use_processes:
+        # Spawned rather than forked, the caller may be running other threads
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        results = list(executor.map(process_image, image_files))
 
-    # Process images in parallel using ThreadPoolExecutor
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(process_image, image_files)
+    for file_path, result in zip(image_files, results):
+        if result is not None:
+            fingerprints[os.path.basename(file_path)] = result
+    temp_path = fingerprint_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(fingerprints, f)
+    os.replace(temp_path, fingerprint_path)
@@ -0,0 +1,230 @@
+import concurrent.futures
+import hashlib
+import mimetypes
+import os
+import shutil
+import sqlite3
+import threading
+from typing import AsyncIterator, Dict, Iterable, Optional
+from urllib.parse import urlparse
+import httpx
+from pdfdeal.FileTools.extract_img import get_imgcdnlink_list
+
+
+def image_folder(md_file: str) -> str:
+    """Folder of the local images of a markdown file, as used by md_replace_imgs"""
+    return os.path.splitext(md_file)[0] + "_img"
+
+
+class ImageFetcher:
+    """Download the images of markdown files through a shared on-disk cache
+
+    Images are stored once, named after the SHA-256 of their content, in a
+    cache shared by every document: a figure seen in an earlier run or in
+    another document is not downloaded again. An SQLite index maps each URL
+    to its file along with the ETag and Last-Modified headers of the
+    response, which are sent back as a conditional request to revalidate the
+    copy. If the request fails, e.g. because the Doc2X link expired, the
+    cached copy is used.
+
+    Downloads run on a pool of ``threads`` threads sharing one HTTP client,
+    and each URL is fetched at most once per process however many documents
+    or calls ask for it, so images can be prefetched while translating. A URL
+    that failed is not requested again during the run, its link is kept.
+    """
+
+    def __init__(
+        self,
+        path: str = "./Output/image_cache",
+        threads: int = 10,
+        revalidate: bool = True,
+    ):
+        """
+        Args:
+            path: Folder of the image cache
+            threads: Number of images downloaded at the same time
+            revalidate: Send a conditional request for images already cached,
+                        otherwise cached images are used without any request
+        """
+        self.path = path
+        self.threads = max(1, threads)
+        self.revalidate = revalidate
+        self.hits = 0
+        self.downloads = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(path, "index.sqlite3"), check_same_thread=False
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "url TEXT PRIMARY KEY, file TEXT NOT NULL, etag TEXT, last_modified TEXT)"
+        )
+        self._conn.commit()
+        self._client = httpx.Client(
+            timeout=httpx.Timeout(60),
+            limits=httpx.Limits(
+                max_connections=self.threads, max_keepalive_connections=self.threads
+            ),
+            follow_redirects=True,
+        )
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        # Future of each URL requested, failed URLs keep theirs so later
+        # passes of the run skip them
+        self._futures = {}
+
+    def fetch_async(self, url: str) -> concurrent.futures.Future:
+        """Start fetching an image, returns a future of its path (None on failure)"""
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = self._executor.submit(self._fetch, url)
+                self._futures[url] = future
+            return future
+
+    def fetch(self, url: str) -> Optional[str]:
+        """Return the path of the cached image, downloading it if needed"""
+        return self.fetch_async(url).result()
+
+    def fetch_all(self, urls: Iterable[str]) -> Dict[str, str]:
+        """Fetch images in parallel, returns the path of each image fetched"""
+        futures = {url: self.fetch_async(url) for url in urls}
+        paths = {url: future.result() for url, future in futures.items()}
+        return {url: path for url, path in paths.items() if path is not None}
+
+    def prefetch(self, text: str) -> None:
+        """Start downloading the images linked from a markdown text"""
+        for url in get_imgcdnlink_list(text)[1]:
+            if url.startswith("http"):
+                self.fetch_async(url)
+
+    async def prefetch_pages(self, pages: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Pass pages through, prefetching their images as they arrive"""
+        async for page in pages:
+            self.prefetch(page)
+            yield page
+
+    def _lookup(self, url: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file, etag, last_modified FROM images WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not os.path.exists(os.path.join(self.path, row[0])):
+            return None
+        return row
+
+    def _fetch(self, url: str) -> Optional[str]:
+        cached = self._lookup(url)
+        if cached is not None and not self.revalidate:
+            with self._lock:
+                self.hits += 1
+            return os.path.abspath(os.path.join(self.path, cached[0]))
+        headers = {}
+        if cached is not None:
+            if cached[1]:
+                headers["If-None-Match"] = cached[1]
+            if cached[2]:
+                headers["If-Modified-Since"] = cached[2]
+        try:
+            response = self._client.get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except Exception as e:
+            if cached is None:
+                print(f"Error downloading image {url}, keeping its link: {e}")
+                with self._lock:
+                    self.failures += 1
+                return None
+            response = None
+        if cached is not None and (response is None or response.status_code == 304):
+            with self._lock:
+                self.hits += 1
+            return os.path.abspath(os.path.join(self.path, cached[0]))
+
+        name = hashlib.sha256(response.content).hexdigest()
+        content_type = response.headers.get("Content-Type", "").split(";")[0]
+        extension = (
+            mimetypes.guess_extension(content_type.strip())
+            or os.path.splitext(urlparse(url).path)[1]
+            or ".png"
+        )
+        file = os.path.join(name[:2], name + extension)
+        image_path = os.path.join(self.path, file)
+        if not os.path.exists(image_path):
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            temp_path = f"{image_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(response.content)
+            os.replace(temp_path, image_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                (
+                    url,
+                    file,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                ),
+            )
+            self._conn.commit()
+            self.downloads += 1
+        return os.path.abspath(image_path)
+
+    def is_cached(self, path: str) -> bool:
+        """Whether a local path points into the cache"""
+        folder = os.path.abspath(self.path)
+        try:
+            return os.path.commonpath([os.path.abspath(path), folder]) == folder
+        except ValueError:
+            return False
+
+    def replace_images(self, md_file: str, folder: str = None) -> bool:
+        """Replace the image links of a markdown file with local copies
+
+        Like ``md_replace_imgs(mdfile, replace="local")``, every image is copied
+        to the folder of the file, ``<name>_img`` by default, and the links are
+        replaced with absolute paths. Links into the cache are copied as well,
+        so the outputs never depend on the cache and pandoc fixes never alter it.
+
+        Returns:
+            bool: Whether every image could be fetched
+        """
+        with open(md_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        links, urls = get_imgcdnlink_list(content)
+        links = [
+            (link, url)
+            for link, url in zip(links, urls)
+            if url.startswith("http") or self.is_cached(url)
+        ]
+        if not links:
+            return True
+        local = self.fetch_all({url for _, url in links if url.startswith("http")})
+        folder = folder or image_folder(md_file)
+        os.makedirs(folder, exist_ok=True)
+        complete = True
+        for link, url in links:
+            source = url if self.is_cached(url) else local.get(url)
+            if source is None or not os.path.exists(source):
+                complete = False
+                continue
+            # A copy rather than a link: the copy may be resaved in place
+            image_path = os.path.abspath(os.path.join(folder, os.path.basename(source)))
+            if not os.path.exists(image_path):
+                shutil.copyfile(source, image_path)
+            content = content.replace(link, f"![{url}](<{image_path}>)\n")
+        with open(md_file, "w", encoding="utf-8") as f:
+            f.write(content)
+        return complete
+
+    def summary(self) -> str:
+        return (
+            f"Images: {self.downloads} downloaded, {self.hits} from cache, "
+            f"{self.failures} failed"
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._client.close()
+        self._conn.close()
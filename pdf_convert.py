@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Tuple
+import httpx
+from pdfdeal.Doc2X.ConvertV2 import Base_URL, upload_pdf
+from pdfdeal.Doc2X.Exception import RequestError, async_retry, code_check
+
+# Options of the conversions requested from Doc2X, part of the cache key
+CONVERSION_OPTIONS = {"endpoint": "v2/parse/pdf", "convert_math": False}
+
+
+class ConversionStopped(Exception):
+    """Raised when waiting for a Doc2X conversion is stopped by is_running"""
+
+
+def check_apikey(apikey: str) -> None:
+    """Raise if the Doc2X API key is missing or still the example value"""
+    if apikey in (None, "", "sk-1234567", "sk-xxx"):
+        print("Error: Please set your DOC2X_APIKEY")
+        raise Exception("Please set your DOC2X_APIKEY")
+
+
+class PollInterval:
+    """Adaptive delay between two status requests of a Doc2X conversion
+
+    The conversion speed is estimated from the progress Doc2X reports, and the
+    next request is made around when half of the remaining work should be
+    done: small PDFs are checked again quickly, long conversions rarely. While
+    the progress does not move, the delay grows by half at every request.
+    """
+
+    def __init__(self, minimum: float = 1.0, maximum: float = 15.0):
+        """
+        Args:
+            minimum: Shortest delay, in seconds
+            maximum: Longest delay, in seconds
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.delay = minimum
+        self._last = None
+
+    def next(self, progress: int) -> float:
+        """Return the delay before the next request, given the current progress"""
+        now = time.monotonic()
+        if self._last is None:
+            self._last = (now, progress)
+        elif progress > self._last[1]:
+            elapsed = now - self._last[0]
+            remaining = (100 - progress) * elapsed / (progress - self._last[1])
+            self.delay = remaining / 2
+            self._last = (now, progress)
+        else:
+            self.delay *= 1.5
+        self.delay = min(max(self.delay, self.minimum), self.maximum)
+        return self.delay
+
+
+@async_retry()
+async def page_status(
+    client: httpx.AsyncClient, apikey: str, uid: str
+) -> Tuple[int, str, dict]:
+    """Fetch the status of a Doc2X conversion with the pages parsed so far
+
+    Unlike ``uid_status``, pages already present in the result are returned
+    while the conversion is still processing. Like it, network errors and
+    timeouts are retried with a backoff, so a blip does not end the conversion.
+
+    Returns:
+        Tuple[int, str, dict]: The progress, the status and the markdown of the
+        available pages by page index
+    """
+    response = await client.get(
+        f"{Base_URL}/v2/parse/status",
+        params={"uid": uid},
+        headers={"Authorization": f"Bearer {apikey}"},
+    )
+    trace_id = response.headers.get("trace-id", "Failed to get trace-id ")
+    if response.status_code != 200:
+        raise Exception(
+            f"Get status error! Trace-id:{trace_id}:{response.status_code}:{response.text}"
+        )
+    data = json.loads(response.content.decode("utf-8"))
+    await code_check(data.get("code", data), uid, trace_id=trace_id)
+    data = data.get("data") or {}
+    status = data.get("status", "")
+    if status == "failed":
+        raise RequestError(
+            f"Failed to deal with file uid {uid}! Trace-id:{trace_id}:{response.text}"
+        )
+    pages = {
+        page.get("page_idx", i): page.get("md", "")
+        for i, page in enumerate((data.get("result") or {}).get("pages") or [])
+    }
+    progress = 100 if status == "success" else data.get("progress", 0)
+    return progress, status, pages
+
+
+async def stream_pages(
+    apikey: str,
+    uid: str,
+    poll: PollInterval = None,
+    on_status: callable = None,
+    is_running: callable = None,
+) -> AsyncIterator[str]:
+    """Yield the markdown of each page of a Doc2X conversion as soon as it is available
+
+    Pages are yielded in page order: a page is only yielded once every page
+    before it is, so they can be translated and written out in order while
+    Doc2X converts the rest of the document.
+
+    Args:
+        apikey: The Doc2X API key
+        uid: The uid returned by the upload
+        poll: Delay between two status requests, adaptive by default
+        on_status: Called with the progress (0 to 100) and status after every request
+        is_running: Returns False to stop waiting
+
+    Raises:
+        ConversionStopped: If is_running returned False before the last page
+    """
+    if poll is None:
+        poll = PollInterval()
+    next_page = 0
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30)) as client:
+        while is_running is None or is_running():
+            progress, status, pages = await page_status(client, apikey, uid)
+            if on_status is not None:
+                on_status(progress, status)
+            if status == "success":
+                for page_idx in sorted(i for i in pages if i >= next_page):
+                    yield pages[page_idx]
+                return
+            while next_page in pages:
+                yield pages[next_page]
+                next_page += 1
+            await asyncio.sleep(poll.next(progress))
+    # Stopping must not look like a complete conversion to the caller
+    raise ConversionStopped(f"Stopped waiting for the conversion of {uid}")
+
+
+@dataclass
+class Doc2XJob:
+    """A PDF converted by Doc2X"""
+
+    pdf_file: str
+    uid: str = None
+    # queued, uploading, processing, success, stopped or failed
+    status: str = "queued"
+    progress: int = 0
+    error: str = None
+    # Key of the conversion in the ConversionCache, and the pages found there
+    cache_key: str = None
+    pages: List[str] = None
+
+
+class Doc2XJobManager:
+    """Upload PDFs to Doc2X and follow their conversions
+
+    Uploads run concurrently from any number of threads, at most
+    ``max_uploads`` at a time. Conversions are polled with an adaptive
+    interval. The state of every job is kept in ``jobs`` and reported to
+    ``on_progress`` after every change.
+
+    With a ConversionCache, a PDF converted before is neither uploaded nor
+    polled: its pages come from the cache, and new conversions are stored in it.
+    """
+
+    def __init__(
+        self,
+        apikey: str,
+        max_uploads: int = 4,
+        min_interval: float = 1.0,
+        max_interval: float = 15.0,
+        on_progress: callable = None,
+        cache=None,
+    ):
+        """
+        Args:
+            apikey: The Doc2X API key
+            max_uploads: Maximum number of uploads at the same time
+            min_interval: Shortest delay between two status requests of a job
+            max_interval: Longest delay between two status requests of a job
+            on_progress: Called with the Doc2XJob after every change
+            cache: Optional ConversionCache
+        """
+        self.apikey = apikey
+        self.max_uploads = max(1, max_uploads)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.on_progress = on_progress
+        self.cache = cache
+        self.jobs = {}
+        self._uploads = threading.BoundedSemaphore(self.max_uploads)
+        self._lock = threading.Lock()
+
+    def _update(self, job: Doc2XJob, **fields) -> None:
+        with self._lock:
+            for name, value in fields.items():
+                setattr(job, name, value)
+        if self.on_progress is not None:
+            self.on_progress(job)
+
+    def upload(self, pdf_file: str) -> Doc2XJob:
+        """Upload a PDF, waiting while ``max_uploads`` uploads are running"""
+        job = Doc2XJob(pdf_file)
+        with self._lock:
+            self.jobs[pdf_file] = job
+        if self.cache is not None:
+            key = self.cache.make_key(pdf_file, CONVERSION_OPTIONS)
+            pages = self.cache.get(key)
+            if pages is not None:
+                print(f"Using the cached Doc2X conversion of {pdf_file}")
+                self._update(
+                    job, cache_key=key, pages=pages, status="success", progress=100
+                )
+                return job
+            job.cache_key = key
+        check_apikey(self.apikey)
+        with self._uploads:
+            self._update(job, status="uploading")
+            try:
+                uid = asyncio.run(upload_pdf(apikey=self.apikey, pdffile=pdf_file))
+            except Exception as e:
+                self._update(job, status="failed", error=str(e))
+                raise
+        self._update(job, uid=uid, status="processing")
+        return job
+
+    async def pages(
+        self, job: Doc2XJob, is_running: callable = None
+    ) -> AsyncIterator[str]:
+        """Yield the pages of a job as they are converted, see stream_pages"""
+        if job.pages is not None:
+            for page in job.pages:
+                yield page
+            return
+
+        def on_status(progress: int, status: str) -> None:
+            if progress != job.progress or status == "success":
+                self._update(
+                    job,
+                    progress=progress,
+                    status="success" if status == "success" else "processing",
+                )
+
+        pages = []
+        try:
+            async for page in stream_pages(
+                self.apikey,
+                job.uid,
+                PollInterval(self.min_interval, self.max_interval),
+                on_status,
+                is_running,
+            ):
+                pages.append(page)
+                yield page
+        except ConversionStopped:
+            self._update(job, status="stopped")
+            raise
+        except Exception as e:
+            self._update(job, status="failed", error=str(e))
+            raise
+        if self.cache is not None and job.status == "success":
+            # Downloading the images must not hold up the event loop
+            await asyncio.to_thread(self.cache.put, job.cache_key, pages)
+
+    async def wait(self, job: Doc2XJob, is_running: callable = None) -> List[str]:
+        """Wait for a job to be converted and return the markdown of every page
+
+        Returns:
+            List[str]: The markdown of every page, [] if stopped by is_running
+        """
+        try:
+            return [page async for page in self.pages(job, is_running)]
+        except ConversionStopped:
+            return []
+
+
+def save_markdown(texts: List[str], pdf_file: str, output_path: str = "Output") -> str:
+    """Write the converted pages of a PDF to a markdown file and return its path"""
+    output_md_path = os.path.join(
+        output_path, ".".join(os.path.basename(pdf_file).split(".")[:-1]) + ".md"
+    )
+    os.makedirs(output_path, exist_ok=True)
+    with open(output_md_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(texts))
+    return output_md_path
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Number of hits whose last use is held in memory before it is written
+TOUCH_BATCH = 256
+
+
+class TranslateCache:
+    """Disk-backed translation cache stored in SQLite.
+
+    Entries are keyed on a SHA-256 of the translator namespace (translator name,
+    model, languages and prompts) together with the block text and its
+    previous/next context. Once more than ``max_entries`` rows are stored the
+    least recently used ones are evicted.
+
+    The last use of a hit is not written right away: hits are looked up from
+    the event loop, so their updates are batched and written along with the
+    next ``set``, every ``TOUCH_BATCH`` hits, or on ``flush``/``close``.
+    """
+
+    def __init__(
+        self,
+        path: str = "./Output/translate_cache.sqlite3",
+        max_entries: int = 100000,
+    ):
+        """Open (or create) the cache database
+
+        Args:
+            path: Path to the SQLite database file
+            max_entries: Maximum number of cached translations to keep
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Last use of the keys hit since the last write
+        self._touched = {}
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(namespace: str, text: str, prev_text: str, next_text: str) -> str:
+        payload = json.dumps(
+            [namespace, text, prev_text, next_text], ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, namespace: str, text: str, prev_text: str, next_text: str):
+        """Return the cached translation, or None on a miss"""
+        key = self.make_key(namespace, text, prev_text, next_text)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._conn.commit()
+            return row[0]
+
+    def set(
+        self, namespace: str, text: str, prev_text: str, next_text: str, value: str
+    ) -> None:
+        """Store a translation, evicting the least recently used entries if full"""
+        key = self.make_key(namespace, text, prev_text, next_text)
+        with self._lock:
+            # Written first, so eviction sees the latest uses
+            self._write_touched()
+            existed = self._conn.execute(
+                "SELECT 1 FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, last_used) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            if not existed:
+                self._count += 1
+            if self._count > self.max_entries:
+                overflow = self._count - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self._count -= overflow
+            self._conn.commit()
+
+    def _write_touched(self) -> None:
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def flush(self) -> None:
+        """Write the last use of the hits not written yet"""
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+
+    def purge(self) -> None:
+        """Remove every cached translation"""
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+            self._count = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+            self._conn.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (
+            f"Translation cache: {self.hits} hits, {self.misses} misses "
+            f"({rate:.1f}% hit rate), {self._count} entries"
+        )
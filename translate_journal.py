@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class TranslateJournal:
+    """Append-only JSONL journal of translated blocks
+
+    Every block is written to the journal as soon as its translation completes,
+    so an interrupted job can be resumed: blocks found in the journal (same
+    place in the document and same source text) are not sent again.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """Open the journal
+
+        Args:
+            path: Path to the journal file
+            resume: Load the existing journal and append to it, otherwise start over
+        """
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be cut off if the process was killed
+                        continue
+                    self.done[entry["key"]] = entry["content"]
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    @staticmethod
+    def make_key(position: int, sub_position: int, type: str, content: str) -> str:
+        payload = json.dumps(
+            [position, sub_position, type, content], ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the journaled translation, or None if the block is not done"""
+        return self.done.get(key)
+
+    def record(self, key: str, content: str) -> None:
+        """Append a translated block and flush it to disk"""
+        line = json.dumps({"key": key, "content": content}, ensure_ascii=False)
+        with self._lock:
+            self.done[key] = content
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def remove(self) -> None:
+        """Close and delete the journal once the job has completed"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
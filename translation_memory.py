@@ -0,0 +1,210 @@
+import hashlib
+import os
+import re
+import sqlite3
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+# MinHash signature of 16 values, split into 4 bands of 4 values for the
+# locality-sensitive index: texts with a Jaccard similarity of about 0.7 or
+# more share at least one band with high probability
+NUM_HASHES = 16
+BANDS = 4
+ROWS = NUM_HASHES // BANDS
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """Word n-grams of a text, or character n-grams when it has too few words"""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) >= size:
+        return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+    compact = "".join(words)
+    return {compact[i : i + 4] for i in range(max(1, len(compact) - 3))}
+
+
+def minhash(shingle_set: set) -> Tuple[int, ...]:
+    """MinHash signature of a set of shingles
+
+    Each shingle is hashed once with BLAKE2b, whose digest provides the
+    NUM_HASHES independent 32-bit hash values.
+    """
+    rows = [
+        struct.unpack(
+            f"<{NUM_HASHES}I",
+            hashlib.blake2b(s.encode("utf-8"), digest_size=NUM_HASHES * 4).digest(),
+        )
+        for s in shingle_set
+    ]
+    return tuple(min(column) for column in zip(*rows))
+
+
+def band_keys(signature: Tuple[int, ...]) -> List[int]:
+    """Keys of the LSH bands of a signature, as signed 64-bit integers"""
+    keys = []
+    for band in range(BANDS):
+        values = signature[band * ROWS : (band + 1) * ROWS]
+        digest = hashlib.blake2b(
+            struct.pack(f"<B{ROWS}I", band, *values), digest_size=8
+        ).digest()
+        keys.append(struct.unpack("<q", digest)[0])
+    return keys
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class TranslationMemory:
+    """Translation memory of source and translated blocks, shared across documents
+
+    Blocks are stored with their formulas masked, so a block only differing by
+    its formulas is an exact match. Near duplicates are found with a MinHash
+    index over word 3-grams and confirmed with their exact Jaccard similarity.
+    Entries are separated by the translator namespace, like the cache. Once
+    more than ``max_entries`` blocks are stored the oldest ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = "./Output/translation_memory.sqlite3",
+        similarity: float = 0.7,
+        max_entries: int = 100000,
+    ):
+        """Open (or create) the translation memory
+
+        Args:
+            path: Path to the SQLite database file
+            similarity: Minimum Jaccard similarity of a near-duplicate match
+            max_entries: Maximum number of blocks to keep
+        """
+        self.path = path
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.exact = 0
+        self.similar = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, source TEXT NOT NULL, "
+            "translated TEXT NOT NULL, UNIQUE (namespace, source))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bands ("
+            "key INTEGER NOT NULL, entry_id INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_entry ON bands (entry_id)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def lookup(
+        self, namespace: str, text: str, fuzzy: bool = True
+    ) -> Optional[Tuple[float, str, str]]:
+        """Find the stored block closest to text
+
+        Args:
+            namespace: The translator namespace
+            text: The block to translate
+            fuzzy: Also look for near duplicates, not only exact matches
+
+        Returns:
+            Optional[Tuple[float, str, str]]: The similarity (1.0 for an exact
+            match), source and translation of the best match, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT translated FROM entries WHERE namespace = ? AND source = ?",
+                (namespace, text),
+            ).fetchone()
+            if row is not None:
+                self.exact += 1
+                return 1.0, text, row[0]
+            if not fuzzy:
+                self.misses += 1
+                return None
+            shingle_set = shingles(text)
+            keys = band_keys(minhash(shingle_set))
+            candidates = self._conn.execute(
+                "SELECT DISTINCT e.source, e.translated FROM bands b "
+                "JOIN entries e ON e.id = b.entry_id "
+                f"WHERE b.key IN ({', '.join('?' * len(keys))}) AND e.namespace = ? "
+                "LIMIT 50",
+                (*keys, namespace),
+            ).fetchall()
+            best = None
+            for source, translated in candidates:
+                score = jaccard(shingle_set, shingles(source))
+                if score >= self.similarity and (best is None or score > best[0]):
+                    best = (score, source, translated)
+            if best is None:
+                self.misses += 1
+            else:
+                self.similar += 1
+            return best
+
+    def add(self, namespace: str, source: str, translated: str) -> None:
+        """Store a translated block, replacing an older translation of it"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, translated FROM entries WHERE namespace = ? AND source = ?",
+                (namespace, source),
+            ).fetchone()
+            if row is not None:
+                if row[1] != translated:
+                    self._conn.execute(
+                        "UPDATE entries SET translated = ? WHERE id = ?",
+                        (translated, row[0]),
+                    )
+                    self._conn.commit()
+                return
+            cursor = self._conn.execute(
+                "INSERT INTO entries (namespace, source, translated) VALUES (?, ?, ?)",
+                (namespace, source, translated),
+            )
+            self._conn.executemany(
+                "INSERT INTO bands (key, entry_id) VALUES (?, ?)",
+                [
+                    (key, cursor.lastrowid)
+                    for key in band_keys(minhash(shingles(source)))
+                ],
+            )
+            self._count += 1
+            if self._count > self.max_entries:
+                # Lookups do not write, so the oldest blocks go first
+                overflow = self._count - self.max_entries
+                evicted = self._conn.execute(
+                    "SELECT id FROM entries ORDER BY id ASC LIMIT ?", (overflow,)
+                ).fetchall()
+                self._conn.executemany("DELETE FROM bands WHERE entry_id = ?", evicted)
+                self._conn.executemany("DELETE FROM entries WHERE id = ?", evicted)
+                self._count -= len(evicted)
+            self._conn.commit()
+
+    def purge(self) -> None:
+        """Remove every stored block"""
+        with self._lock:
+            self._conn.execute("DELETE FROM bands")
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+            self._count = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def summary(self) -> str:
+        return (
+            f"Translation memory: {self.exact} exact matches, {self.similar} similar "
+            f"matches, {self.misses} misses, {self._count} entries"
+        )